@@ -2,14 +2,21 @@
 import atexit
 import os
 import queue
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 
 # Third party imports, installable via pip:
 import napari
 import numpy as np
-from scipy.ndimage import zoom, rotate, gaussian_filter1d
-from tifffile import imread, imwrite
+from numba import njit
+from scipy.interpolate import RBFInterpolator
+from scipy.ndimage import zoom, rotate, affine_transform, gaussian_filter1d
+from scipy.special import cosdg, sindg
+from tifffile import imread, imwrite, memmap
 
 # Our code, one .py file per module, copy files to your local directory:
 try:
@@ -44,6 +51,9 @@ emission_filter_options = {'Shutter'                :0,
                            'LP02-488RU'             :7,
                            'LP02-561RU'             :8,
                            '(unused)'               :9}
+# Approximate worst case Lambda 10-3 move (5 positions, default speed), the
+# min 'filter_wheel_move_s' for 'channels_per_volume':
+filter_wheel_max_move_s = 0.08
 
 class Microscope:
     def __init__(self,
@@ -87,6 +97,11 @@ class Microscope:
         self.focus_piezo_z_um = self.focus_piezo.z
         self.XY_stage_position_mm = self.XY_stage.x, self.XY_stage.y
         self.camera_preframes = 0 # ditch some noisy frames before recording?
+        self.bidirectional_scan = False # True -> odd volumes scan backwards
+        self.galvo_flyback_us = 0 # 0 = galvo jumps back between volumes
+        self.inter_volume_delay_s = 0 # idle time between volumes (in buffer)
+        self.channels_per_volume = False # True -> one channel per volume
+        self.filter_wheel_move_s = 0.1 # time allowed for 'channels_per_volume'
         self.max_bytes_per_buffer = (2**31) # legal tiff
         self.max_data_buffers = 4 # camera, preview, display, filesave
         self.max_preview_buffers = self.max_data_buffers
@@ -94,6 +109,9 @@ class Microscope:
         # The pco_edge42_cl has unreliable pixel rows at the top and bottom,
         # so for clean previews it's best to remove them:
         self.preview_crop_px = 3 # crop top and bottom pixel rows for previews
+        # Faster/smaller previews for unsaved acquisitions (i.e. live mode):
+        self.preview_binning = 1 # max bin 'n x n' pixels (e.g. 2 or 4)
+        self.preview_slice_step = 1 # only preview every 'nth' slice
         # -> additional
         self.dichroic_mirror = tuple(dichroic_mirror_options.keys())[0]
         self.num_active_data_buffers = 0
@@ -156,6 +174,8 @@ class Microscope:
     def _init_datapreview(self):
         if self.verbose: print("\n%s: opening datapreview..."%self.name) 
         self.datapreview = ct.ObjectInSubprocess(DataPreview)
+        # Streaming previews run alongside the camera in this process:
+        self._streaming_datapreview = DataPreview()
         if self.verbose: print("\n%s: -> datapreview open."%self.name) 
 
     def _init_ao(self, ao_rate):
@@ -179,6 +199,11 @@ class Microscope:
         if self.verbose: print("\n%s: opening ao card..."%self.name)
         self.ao = ni_PXIe_6739.DAQ(
             num_channels=30, rate=ao_rate, verbose=False)
+        # Voltages are cached by settings (switching back and forth between
+        # settings is common) and only written if not already on the card:
+        self._voltages_cache = OrderedDict() # least recently used first
+        self.max_voltages_cache_bytes = 1e8  # compact '_Waveform' bytes
+        self._loaded_voltages_key = None
         if self.verbose: print("\n%s: -> ao card open."%self.name)
         atexit.register(self.ao.close)
 
@@ -198,28 +223,53 @@ class Microscope:
                 print("%s: -> reduce settings"%self.name +
                       " or increase 'max_bytes_per_buffer'")
         # Preview:
-        preview_shape = DataPreview.shape(self.volumes_per_buffer,
-                                          self.slices_per_volume,
-                                          len(self.channels_per_slice),
-                                          self.height_px,
-                                          self.width_px,
-                                          self.scan_step_size_px,
-                                          self.preview_line_px,
-                                          self.preview_crop_px,
-                                          self.timestamp_mode)
-        self.bytes_per_preview_buffer = 2 * int(np.prod(preview_shape))
+        # -> unsaved acquisitions use 'preview_binning/slice_step' but saved
+        # acquisitions always get a full preview, so check both:
+        preview_bytes = []
+        for pb, ps in ((self.preview_binning, self.preview_slice_step),
+                       (1, 1)):
+            preview_shape = DataPreview.shape(self.volumes_per_buffer,
+                                              self.slices_per_volume,
+                                              len(self.channels_per_slice),
+                                              self.height_px,
+                                              self.width_px,
+                                              self.scan_step_size_px,
+                                              self.preview_line_px,
+                                              self.preview_crop_px,
+                                              self.timestamp_mode,
+                                              pb,
+                                              ps)
+            preview_bytes.append(2 * int(np.prod(preview_shape)))
+        self.bytes_per_preview_buffer = preview_bytes[0]
+        self.bytes_per_full_preview_buffer = preview_bytes[1]
         self.preview_buffer_exceeded = False
-        if self.bytes_per_preview_buffer > self.max_bytes_per_buffer:
+        if self.bytes_per_full_preview_buffer > self.max_bytes_per_buffer:
             self.preview_buffer_exceeded = True
             if self.print_warnings:
                 print("\n%s: ***WARNING***: settings rejected"%self.name)
                 print("%s: -> preview_buffer_exceeded"%self.name)
                 print("%s: -> reduce settings"%self.name +
                       " or increase 'max_bytes_per_buffer'")
+        # Voltages: compact ('_Waveform') but expanded for the ao card when
+        # written (approximate, the rolling time follows 'height_px'):
+        period_px = (self.ao.s2p(1e-6 * (self.illumination_time_us +
+                                         self.camera.rolling_time_us)) +
+                     max(self.ao.s2p(30e-6), 1))
+        volumes = self.volumes_per_buffer
+        gap_px = self.ao.s2p(self.inter_volume_delay_s) # between volumes
+        if not self.bidirectional_scan:
+            gap_px = max(gap_px, self.ao.s2p(1e-6 * self.galvo_flyback_us))
+        if self.channels_per_volume: # (upper bound)
+            volumes = volumes * len(self.channels_per_slice)
+            gap_px = max(gap_px, self.ao.s2p(self.filter_wheel_move_s))
+        self.bytes_per_voltage_buffer = 8 * self.ao.num_channels * (
+            period_px * (self.images + self.camera_preframes) +
+            gap_px * (volumes - 1))
         # Total:
         self.total_bytes = (
             self.bytes_per_data_buffer * self.max_data_buffers +
-            self.bytes_per_preview_buffer * self.max_preview_buffers)
+            self.bytes_per_full_preview_buffer * self.max_preview_buffers +
+            self.bytes_per_voltage_buffer)
         self.total_bytes_exceeded = False
         if self.total_bytes > self.max_allocated_bytes:
             self.total_bytes_exceeded = True
@@ -230,7 +280,7 @@ class Microscope:
                       " or increase 'max_allocated_bytes'")
         return None
 
-    def _calculate_voltages(self):
+    def _calculate_voltages(self, first_volume_only=False):
         n2c = self.names_to_voltage_channels # nickname
         # Timing information:
         exposure_px = self.ao.s2p(1e-6 * self.camera.exposure_us)
@@ -242,41 +292,200 @@ class Microscope:
         galvo_scan_volts = galvo_volts_per_um * self.scan_range_um
         galvo_voltages = np.linspace(
             - galvo_scan_volts/2, galvo_scan_volts/2, self.slices_per_volume)
-        # Calculate voltages:
-        voltages = []
+        # Calculate voltages: one period per channel, compressed to runs of
+        # constant voltages and repeated for 'preframes + tzc' periods:
+        pf = self.camera_preframes
+        sl = self.slices_per_volume
+        ch = len(self.channels_per_slice)
+        nc = self.ao.num_channels
+        periods = np.zeros((ch, period_px, nc), 'float64')
+        periods[:, :rolling_px, n2c['camera']] = 5 # falling edge-> light on!
+        for c, (channel, power) in enumerate(zip(self.channels_per_slice,
+                                                 self.power_per_channel)):
+            light_on_px = rolling_px
+            if channel in ('405_on_during_rolling',): light_on_px = 0
+            if channel != 'LED': # i.e. laser channels
+                periods[c, light_on_px:period_px - jitter_px,
+                        n2c[channel + '_TTL']] = 3
+            periods[c, light_on_px:period_px - jitter_px,
+                    n2c[channel + '_power']] = 4.5 * power / 100
+        slice_runs = [_Waveform.runs(period) for period in periods]
         # Add preframes (if any):
-        for frames in range(self.camera_preframes):
-            v = np.zeros((period_px, self.ao.num_channels), 'float64')
-            v[:rolling_px, n2c['camera']] = 5 # falling edge-> light on!
-            voltages.append(v)
-        for volumes in range(self.volumes_per_buffer):
-            # TODO: either bidirectional volumes, or smoother galvo flyback
-            for _slice in range(self.slices_per_volume):
-                for channel, power in zip(self.channels_per_slice,
-                                          self.power_per_channel):
-                    v = np.zeros((period_px, self.ao.num_channels), 'float64')
-                    v[:rolling_px, n2c['camera']] = 5 # falling edge-> light on!
-                    v[:, n2c['galvo']] = galvo_voltages[_slice]
-                    light_on_px = rolling_px
-                    if channel in ('405_on_during_rolling',): light_on_px = 0
-                    if channel != 'LED': # i.e. laser channels
-                        v[light_on_px:period_px - jitter_px,
-                          n2c[channel + '_TTL']] = 3
-                    v[light_on_px:period_px - jitter_px,
-                      n2c[channel + '_power']] = 4.5 * power / 100
-                    voltages.append(v)
-        voltages = np.concatenate(voltages, axis=0)
+        preframe = np.zeros((period_px, nc), 'float64')
+        preframe[:rolling_px, n2c['camera']] = 5 # falling edge-> light on!
+        preframe_lengths_px, preframe_values = _Waveform.runs(preframe)
+        lengths_px = [np.tile(preframe_lengths_px, pf)]
+        values = [np.tile(preframe_values, (pf, 1))]
+        # Add volumes: for a 'bidirectional_scan' the odd volumes are scanned
+        # backwards (no flyback), otherwise the galvo flies back before each
+        # volume (smoothly with a raised cosine if 'galvo_flyback_us' > 0):
+        flyback_px = self.ao.s2p(1e-6 * self.galvo_flyback_us)
+        flyback = np.zeros((flyback_px, nc), 'float64')
+        flyback[:, n2c['galvo']] = galvo_voltages[-1] + (
+            galvo_voltages[0] - galvo_voltages[-1]) * 0.5 * (
+                1 - np.cos(np.pi * np.arange(1, flyback_px + 1) / flyback_px))
+        # Hardware timed time series: idle (light off) between volumes with
+        # the galvo ready for the next volume ('inter_volume_delay_s' from
+        # the end of one volume to the start of the next, flyback included):
+        delay_px = self.ao.s2p(self.inter_volume_delay_s)
+        # Volumes in acquisition order: every channel on every slice, or one
+        # channel per volume ('channels_per_volume', 'tczyx' order) with
+        # time for the filter wheel to move between channel volumes:
+        volume_channels = self.volumes_per_buffer * [tuple(range(ch))]
+        if self.channels_per_volume:
+            volume_channels = [
+                (c,) for v in range(self.volumes_per_buffer) for c in range(ch)]
+        if first_volume_only: # e.g. 'autofocus' with 'channels_per_volume'
+            volume_channels = volume_channels[:1]
+        filter_positions = self._emission_filter_positions()
+        filter_move_px = self.ao.s2p(self.filter_wheel_move_s)
+        for v, channels in enumerate(volume_channels):
+            volume_galvo_voltages = galvo_voltages
+            if self.bidirectional_scan and v % 2:
+                volume_galvo_voltages = galvo_voltages[::-1]
+            if v > 0:
+                gap_px = 0
+                if not self.bidirectional_scan and flyback_px > 0:
+                    lengths_px.append(np.ones(flyback_px, 'int64'))
+                    values.append(flyback)
+                    gap_px = flyback_px
+                min_gap_px = 0
+                if channels[0] == 0: # new time point
+                    min_gap_px = delay_px
+                if (filter_positions[channels[0]] !=
+                    filter_positions[volume_channels[v - 1][-1]]):
+                    min_gap_px = max(min_gap_px, filter_move_px)
+                if min_gap_px > gap_px:
+                    idle = np.zeros((1, nc), 'float64')
+                    idle[0, n2c['galvo']] = volume_galvo_voltages[0]
+                    lengths_px.append(
+                        np.array((min_gap_px - gap_px,), 'int64'))
+                    values.append(idle)
+            slice_lengths_px = np.concatenate(
+                [slice_runs[c][0] for c in channels])
+            slice_values = np.concatenate([slice_runs[c][1] for c in channels])
+            volume_values = np.tile(slice_values, (sl, 1))
+            volume_values[:, n2c['galvo']] = np.repeat(
+                volume_galvo_voltages, len(slice_values))
+            lengths_px.append(np.tile(slice_lengths_px, sl))
+            values.append(volume_values)
+        voltages = _Waveform(
+            np.concatenate(lengths_px), np.concatenate(values), nc)
+        return voltages
+
+    def _get_cached_voltages(self, key, calculate_voltages):
+        # Least recently used cache of compact voltages ('_Waveform') capped
+        # by 'max_voltages_cache_bytes' (the latest is always kept):
+        cache = self._voltages_cache
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        voltages = calculate_voltages()
+        cache[key] = voltages
+        while (len(cache) > 1 and sum(v.nbytes for v in cache.values()) >
+               self.max_voltages_cache_bytes):
+            cache.popitem(last=False)
+        return voltages
+
+    def _get_voltages(self, first_volume_only=False):
+        # Returns the key and (cached) voltages for the current settings
+        # (or just the first volume, which doesn't change the attributes):
+        key = (tuple(self.channels_per_slice),
+               tuple(self.power_per_channel),
+               self.camera.exposure_us,
+               self.camera.rolling_time_us,
+               self.scan_range_um,
+               self.slices_per_volume,
+               self.volumes_per_buffer,
+               self.bidirectional_scan,
+               self.galvo_flyback_us,
+               self.inter_volume_delay_s,
+               self.channels_per_volume,
+               self.camera_preframes,
+               self.ao.s2p(1)) # ao rate
+        if self.channels_per_volume: # filter moves only matter here
+            key += (self._emission_filter_positions(),
+                    self.filter_wheel_move_s)
+        if first_volume_only:
+            key = ('first_volume_only',) + key
+            return key, self._get_cached_voltages(
+                key, lambda: self._calculate_voltages(first_volume_only))
+        voltages = self._get_cached_voltages(key, self._calculate_voltages)
         # Timing attributes:
         self.buffer_time_s = self.ao.p2s(voltages.shape[0])
         self.volumes_per_s = self.volumes_per_buffer / self.buffer_time_s
-        return voltages
+        return key, voltages
+
+    def _write_voltages(self, key, voltages):
+        # Writes the voltages to the ao card, unless they're already there:
+        if key == self._loaded_voltages_key:
+            return None
+        self._loaded_voltages_key = None # in case the write crashes
+        self.ao._write_voltages(voltages.to_array())
+        self._loaded_voltages_key = key
+        return None
+
+    def _emission_filter_positions(self):
+        # Filter wheel position per channel (one 'emission_filter' for all
+        # channels, or one per channel with 'channels_per_volume'):
+        ch = len(self.channels_per_slice)
+        if isinstance(self.emission_filter, str):
+            return ch * (emission_filter_options[self.emission_filter],)
+        assert self.channels_per_volume, (
+            "%s: one 'emission_filter' per channel needs "%self.name +
+            "'channels_per_volume'")
+        assert len(self.emission_filter) == ch
+        return tuple(emission_filter_options[f] for f in self.emission_filter)
+
+    def _preview_shapes(self, preview_shape):
+        # Returns the raw data and preview shapes for 'DataPreview.get'. With
+        # 'channels_per_volume' the images are recorded 'tczyx', so each
+        # channel volume is previewed as a volume with a single channel (the
+        # preview buffer is the same memory, still 'tcyx'):
+        vo = self.volumes_per_buffer
+        sl = self.slices_per_volume
+        ch = len(self.channels_per_slice)
+        if not self.channels_per_volume:
+            return (vo, sl, ch, self.height_px, self.width_px), preview_shape
+        return ((vo * ch, sl, 1, self.height_px, self.width_px),
+                (vo * ch, 1) + tuple(preview_shape[2:]))
+
+    def _filter_wheel_sequence(self, data_buffer, camera_thread, preframes):
+        # For 'channels_per_volume': moves the filter wheel to the next
+        # channel's filter as soon as the last image of each channel volume
+        # arrives, i.e. during the gap in the voltages ('filter_wheel_move_s').
+        # The moves are software timed, so warn if one overran the gap:
+        positions = self._emission_filter_positions()
+        sl, ch = self.slices_per_volume, len(self.channels_per_slice)
+        for v in range(self.volumes_per_buffer * ch - 1):
+            c, c_next = v % ch, (v + 1) % ch
+            if positions[c_next] == positions[c]:
+                continue
+            last_image = preframes + (v + 1) * sl - 1
+            while not data_buffer[last_image, 0, :].any():
+                if not camera_thread.is_alive():
+                    return None # camera errors are raised by 'acquire'
+                time.sleep(1e-4)
+            t0 = time.perf_counter()
+            self.filter_wheel.move(positions[c_next], block=False)
+            self.filter_wheel._finish_moving()
+            move_s = time.perf_counter() - t0
+            if move_s > self.filter_wheel_move_s and self.print_warnings:
+                print("\n%s: ***WARNING***: filter wheel move "%self.name +
+                      "%0.3fs > 'filter_wheel_move_s' (%0.3fs)"%(
+                          move_s, self.filter_wheel_move_s))
+                print("%s: -> channel %i volume (time point %i) "%(
+                    self.name, c_next, (v + 1) // ch) +
+                      "started before the filter was in place")
+        return None
 
     def _plot_voltages(self):
         import matplotlib.pyplot as plt
         # Reverse lookup table; channel numbers to names:
         c2n = {v:k for k, v in self.names_to_voltage_channels.items()}
-        for c in range(self.voltages.shape[1]):
-            plt.plot(self.voltages[:, c], label=c2n.get(c, f'ao-{c}'))
+        voltages = self.voltages.to_array()
+        for c in range(voltages.shape[1]):
+            plt.plot(voltages[:, c], label=c2n.get(c, f'ao-{c}'))
         plt.legend(loc='upper right')
         xlocs, xlabels = plt.xticks()
         plt.xticks(xlocs, [self.ao.p2s(l) for l in xlocs])
@@ -285,7 +494,7 @@ class Microscope:
         plt.show()
 
     def _prepare_to_save(
-        self, filename, folder_name, description, display, preview_only):
+        self, filename, folder_name, description, display, preview_only, crop):
         def make_folders(folder_name):
             os.makedirs(folder_name)
             os.makedirs(folder_name + '\\data')
@@ -316,9 +525,11 @@ class Microscope:
             'description':description,
             'display':display,
             'preview_only':preview_only,
+            'crop':crop,
             # attributes from 'apply_settings':
             # -> args
             'channels_per_slice':tuple(self.channels_per_slice),
+            'channels_per_volume':self.channels_per_volume,
             'power_per_channel':tuple(self.power_per_channel),
             'emission_filter':self.emission_filter,
             'illumination_time_us':self.illumination_time_us,
@@ -328,6 +539,9 @@ class Microscope:
             'voxel_aspect_ratio':self.voxel_aspect_ratio,
             'scan_range_um':self.scan_range_um,
             'volumes_per_buffer':self.volumes_per_buffer,
+            'bidirectional_scan':self.bidirectional_scan,
+            'galvo_flyback_us':self.galvo_flyback_us,
+            'inter_volume_delay_s':self.inter_volume_delay_s,
             'focus_piezo_z_um':self.focus_piezo_z_um,
             'XY_stage_position_mm':self.XY_stage_position_mm,
             'camera_preframes':self.camera_preframes,
@@ -355,10 +569,11 @@ class Microscope:
             'tilt_deg':np.rad2deg(tilt),
             'dichroic_mirror':self.dichroic_mirror,
             }
-        with open(os.path.splitext(metadata_path)[0] + '.txt', 'w') as file:
+        metadata_path = os.path.splitext(metadata_path)[0] + '.txt'
+        with open(metadata_path, 'w') as file:
             for k, v in to_save.items():
                 file.write(k + ': ' + str(v) + '\n')
-        return data_path, preview_path
+        return data_path, preview_path, metadata_path
 
     def _get_data_buffer(self, shape, dtype):
         while self.num_active_data_buffers >= self.max_data_buffers:
@@ -386,6 +601,24 @@ class Microscope:
         assert isinstance(shared_numpy_array, ct.SharedNDArray)
         self.num_active_preview_buffers -= 1
 
+    def _frames_written_counter(self, data_buffer, camera_thread, preframes):
+        # Returns a function that counts the images (after any preframes) that
+        # camera.record_to_memory() has finished writing into 'data_buffer'.
+        # The images are written in order into zeroed shared memory, so image
+        # 'i' is complete once image 'i + 1' has non-zero pixels (every pixel
+        # has the camera offset, and the timestamp if enabled):
+        images = data_buffer.shape[0]
+        count = 0
+        def frames_written():
+            nonlocal count
+            if not camera_thread.is_alive():
+                camera_thread.get_result() # raises any camera errors
+                count = images
+            while count + 1 < images and data_buffer[count + 1, 0, :].any():
+                count += 1
+            return max(count - preframes, 0)
+        return frames_written
+
     def snoutfocus(self, filename=None, settle_vibrations=True):
         def snoutfocus_task(custody):
             custody.switch_from(None, to=self.camera) # Safe to change settings
@@ -393,17 +626,17 @@ class Microscope:
                 if self.print_warnings:
                     print("\n%s: ***WARNING***: settings not applied"%self.name)
                     print("%s: -> please apply legal settings"%self.name)
-                    print("%s: (all arguments must be specified at least once)")
+                    print("%s: (all arguments must be specified at least "%(
+                        self.name) + "once)")
                 custody.switch_from(self.camera, to=None)
                 return
             self._settings_applied = False # In case the thread crashes
             # Record the settings we'll have to reset:
-            old_fw_pos = emission_filter_options[self.emission_filter]
+            old_fw_pos = self._emission_filter_positions()[0]
             old_images = self.camera.num_images
             old_exp_us = self.camera.exposure_us
             old_roi_px = self.camera.roi_px
             old_timestamp = self.camera.timestamp_mode
-            old_voltages = self.voltages
             # Get microscope settings ready to take our measurement:
             self.filter_wheel.move(emission_filter_options['Open'], block=False)
             self.snoutfocus_piezo.set_voltage(0, block=False) # fw slower
@@ -426,18 +659,23 @@ class Microscope:
             piezo_settling_px = self.ao.s2p(0.000) # Not yet measured
             period_px = (max(exp_px, roll_px, piezo_settling_px) + jitter_px)
             n2c = self.names_to_voltage_channels # A temporary nickname
-            v_open_shutter = np.zeros((self.ao.s2p(5*1e-3), # Shutter open time
-                                       self.ao.num_channels), 'float64')
-            v_open_shutter[:, n2c['snoutfocus_shutter']] = 5
-            voltages = [v_open_shutter] # insert the shutter open array first
-            for piezo_voltage in piezo_voltages:
-                v = np.zeros((period_px, self.ao.num_channels), 'float64')
-                v[:, n2c['snoutfocus_shutter']] = 5
-                v[:roll_px, n2c['camera']] = 5
-                v[:, n2c['snoutfocus_piezo']] = (
-                    10 * (piezo_voltage / piezo_limit_v)) # 10 V
-                voltages.append(v)
-            voltages = np.concatenate(voltages, axis=0)
+            def calculate_voltages():
+                v_open_shutter = np.zeros((self.ao.s2p(5*1e-3), # open time
+                                           self.ao.num_channels), 'float64')
+                v_open_shutter[:, n2c['snoutfocus_shutter']] = 5
+                voltages = [v_open_shutter] # insert the shutter open first
+                for piezo_voltage in piezo_voltages:
+                    v = np.zeros((period_px, self.ao.num_channels), 'float64')
+                    v[:, n2c['snoutfocus_shutter']] = 5
+                    v[:roll_px, n2c['camera']] = 5
+                    v[:, n2c['snoutfocus_piezo']] = (
+                        10 * (piezo_voltage / piezo_limit_v)) # 10 V
+                    voltages.append(v)
+                return _Waveform.from_array(np.concatenate(voltages, axis=0))
+            voltages_key = ('snoutfocus', exp_px, roll_px, period_px,
+                            self.ao.s2p(1))
+            voltages = self._get_cached_voltages(
+                voltages_key, calculate_voltages)
             # Allocate memory and finalize microscope settings:
             data_buffer = self._get_data_buffer(
                 (images, self.camera.height_px, self.camera.width_px), 'uint16')
@@ -448,12 +686,12 @@ class Microscope:
                 target=self.camera.record_to_memory,
                 kwargs={'allocated_memory': data_buffer,
                         'software_trigger': False},).start()
-            self.ao.play_voltages(voltages, block=False) # Ends at 0 V
+            self._write_voltages(voltages_key, voltages)
+            self.ao.play_voltages(block=False) # Ends at 0 V
             camera_thread.get_result()
             # Start cleaning up after ourselves:
-            write_voltages_thread = ct.ResultThread(
-                target=self.ao._write_voltages,
-                args=(old_voltages,)).start()
+            # -> the old voltages are only re-written when needed (i.e. if
+            # the next 'apply_settings' doesn't replace them anyway)
             self.filter_wheel.move(old_fw_pos, block=False)
             # Inspect the images to find/set best snoutfocus piezo position:
             if np.max(data_buffer) < 5 * np.min(data_buffer):
@@ -475,7 +713,6 @@ class Microscope:
             self.camera._arm(self.camera._num_buffers)
             self.snoutfocus_piezo._finish_set_voltage(polling_wait_s=0)
             self.filter_wheel._finish_moving()
-            write_voltages_thread.get_result()
             self._settings_applied = True
             if settle_vibrations:
                     time.sleep(2)
@@ -497,8 +734,10 @@ class Microscope:
     def apply_settings( # Must call before .acquire()
         self,
         channels_per_slice=None,    # Tuple of strings
+        channels_per_volume=None,   # Bool (True = 1 channel per volume)
         power_per_channel=None,     # Tuple of floats
-        emission_filter=None,       # String
+        emission_filter=None,       # String (or tuple per channel if
+                                    # 'channels_per_volume')
         illumination_time_us=None,  # Float
         height_px=None,             # Int
         width_px=None,              # Int
@@ -506,6 +745,9 @@ class Microscope:
         voxel_aspect_ratio=None,    # Int
         scan_range_um=None,         # Int or float
         volumes_per_buffer=None,    # Int
+        bidirectional_scan=None,    # Bool
+        galvo_flyback_us=None,      # Float (0 = jump)
+        inter_volume_delay_s=None,  # Float (0 = none)
         focus_piezo_z_um=None,      # (Float, "relative" or "absolute")
         XY_stage_position_mm=None,  # (Float, Float, "relative" or "absolute")
         camera_preframes=None,      # Int
@@ -514,6 +756,8 @@ class Microscope:
         max_preview_buffers=None,   # Int
         preview_line_px=None,       # Int
         preview_crop_px=None,       # Int
+        preview_binning=None,       # Int (unsaved acquisitions only)
+        preview_slice_step=None,    # Int (unsaved acquisitions only)
         ):
         args = locals()
         args.pop('self')
@@ -544,6 +788,10 @@ class Microscope:
                 self.scan_range_um = calculate_scan_range_um(
                     self.scan_step_size_px, self.slices_per_volume)
                 assert 0 <= self.scan_range_um <= 200 # optical limit
+            if preview_binning is not None or preview_slice_step is not None:
+                assert type(self.preview_binning) is int
+                assert type(self.preview_slice_step) is int
+                assert self.preview_binning > 0 and self.preview_slice_step > 0
             self._check_memory()
             if (self.data_buffer_exceeded or
                 self.preview_buffer_exceeded or
@@ -563,7 +811,7 @@ class Microscope:
                     target=self.XY_stage.get_position_mm).start()
             if emission_filter is not None:
                 self.filter_wheel.move(
-                    emission_filter_options[emission_filter], block=False)
+                    self._emission_filter_positions()[0], block=False)
             if focus_piezo_z_um is not None:
                 assert focus_piezo_z_um[1] in ('relative', 'absolute')
                 z = focus_piezo_z_um[0]
@@ -583,12 +831,17 @@ class Microscope:
                 self.camera._set_timestamp_mode(timestamp_mode)
             check_write_voltages_thread = False
             if (channels_per_slice is not None or
+                channels_per_volume is not None or
+                emission_filter is not None or
                 power_per_channel is not None or
                 height_px is not None or
                 illumination_time_us is not None or
                 voxel_aspect_ratio is not None or
                 scan_range_um is not None or
                 volumes_per_buffer is not None or
+                bidirectional_scan is not None or
+                galvo_flyback_us is not None or
+                inter_volume_delay_s is not None or
                 camera_preframes is not None):
                 for channel in self.channels_per_slice:
                     assert channel in self.illumination_sources
@@ -597,14 +850,28 @@ class Microscope:
                 for power in self.power_per_channel: assert 0 <= power <= 100
                 assert type(self.volumes_per_buffer) is int
                 assert self.volumes_per_buffer > 0
+                assert self.bidirectional_scan in (True, False)
+                assert self.galvo_flyback_us >= 0
+                assert self.inter_volume_delay_s >= 0
+                assert self.channels_per_volume in (True, False)
+                assert not (self.channels_per_volume and
+                            self.bidirectional_scan), (
+                    "%s: 'channels_per_volume' needs unidirectional scans"%(
+                        self.name))
+                if self.channels_per_volume:
+                    assert (self.filter_wheel_move_s >=
+                            filter_wheel_max_move_s), (
+                        "%s: 'filter_wheel_move_s' < "%self.name +
+                        "'filter_wheel_max_move_s' (%0.3fs)"%(
+                            filter_wheel_max_move_s))
                 assert type(self.camera_preframes) is int
                 self.camera.num_images = ( # update attribute
                     self.images + self.camera_preframes)
                 self.camera.num_images = self.images # update attribute
-                self.voltages = self._calculate_voltages()
+                self._voltages_key, self.voltages = self._get_voltages()
                 write_voltages_thread = ct.ResultThread(
-                    target=self.ao._write_voltages,
-                    args=(self.voltages,)).start()
+                    target=self._write_voltages,
+                    args=(self._voltages_key, self.voltages)).start()
                 check_write_voltages_thread = True
             # Finalize hardware commands, fastest to slowest:
             if focus_piezo_z_um is not None:
@@ -632,14 +899,19 @@ class Microscope:
                 folder_name=None,   # None = new folder, same string = re-use
                 description=None,   # Optional metadata description
                 display=True,       # Optional turn off
-                preview_only=False):# Save preview only, raw data discarded
+                preview_only=False, # Save preview only, raw data discarded
+                streaming_preview=False, # Preview while recording (faster)
+                crop=None,          # 'auto' = save the data roi only
+                return_preview=False): # True = '.get_result()' gives a copy
+        assert crop in (None, 'auto')
         def acquire_task(custody):
             custody.switch_from(None, to=self.camera) # get camera
             if not self._settings_applied:
                 if self.print_warnings:
                     print("\n%s: ***WARNING***: settings not applied"%self.name)
                     print("%s: -> please apply legal settings"%self.name)
-                    print("%s: (all arguments must be specified at least once)")
+                    print("%s: (all arguments must be specified at least "%(
+                        self.name) + "once)")
                 custody.switch_from(self.camera, to=None)
                 return
             # must update XY stage position attributes in case joystick was used
@@ -652,7 +924,8 @@ class Microscope:
                           folder_name,
                           description,
                           display,
-                          preview_only)).start()
+                          preview_only,
+                          crop)).start()
             # We have custody of the camera so attribute access is safe:
             vo   = self.volumes_per_buffer
             sl   = self.slices_per_volume
@@ -663,13 +936,34 @@ class Microscope:
             l_px = self.preview_line_px
             c_px = self.preview_crop_px
             ts   = self.timestamp_mode
+            pb   = self.preview_binning
+            ps   = self.preview_slice_step
+            if filename is not None: # saved previews are always full size
+                pb, ps = 1, 1
             im   = self.images + self.camera_preframes
+            pf   = self.camera_preframes
             data_buffer = self._get_data_buffer((im, h_px, w_px), 'uint16')
+            preview_shape = DataPreview.shape(
+                vo, sl, ch, h_px, w_px, s_px, l_px, c_px, ts, pb, ps)
+            recorded_shape, recorded_preview_shape = self._preview_shapes(
+                preview_shape)
+            if streaming_preview: # needed before recording starts
+                preview_buffer = self._get_preview_buffer(
+                    preview_shape, 'uint16')
+            if self.channels_per_volume: # start with the first filter
+                self.filter_wheel.move(
+                    self._emission_filter_positions()[0], block=False)
+                self.filter_wheel._finish_moving()
+            self._write_voltages(self._voltages_key, self.voltages) # if needed
             # camera.record_to_memory() blocks, so we use a thread:
             camera_thread = ct.ResultThread(
                 target=self.camera.record_to_memory,
                 kwargs={'allocated_memory': data_buffer,
                         'software_trigger': False},).start()
+            if self.channels_per_volume: # filter moves between volumes
+                filter_wheel_thread = ct.ResultThread(
+                    target=self._filter_wheel_sequence,
+                    args=(data_buffer, camera_thread, pf)).start()
             # Race condition: the camera starts with (typically 16) single
             # frame buffers, which are filled by triggers from
             # ao.play_voltages(). The camera_thread empties them, hopefully
@@ -681,41 +975,204 @@ class Microscope:
             # (~4GB/s vs ~1GB/s) but this could also be fragile if another
             # process interferes.
             self.ao.play_voltages(block=False)
+            if streaming_preview:
+                # Build the preview in this process as the images arrive,
+                # so it's ready almost as soon as the camera finishes:
+                self._streaming_datapreview.get(
+                    data_buffer[pf:, :, :].reshape(recorded_shape),
+                    s_px, l_px, c_px, ts,
+                    allocated_memory=preview_buffer.reshape(
+                        recorded_preview_shape),
+                    preview_binning=pb,
+                    preview_slice_step=ps,
+                    frames_written=self._frames_written_counter(
+                        data_buffer, camera_thread, pf),
+                    bidirectional=self.bidirectional_scan)
             camera_thread.get_result()
-            custody.switch_from(self.camera, to=self.datapreview)
+            if self.channels_per_volume:
+                filter_wheel_thread.get_result()
             # Acquisition is 3D, but display and filesaving are 5D:
+            recorded_data = data_buffer[pf:, :, :].reshape(recorded_shape)
             data_buffer = data_buffer[ # ditch preframes
-                self.camera_preframes:, :, :].reshape(vo, sl, ch, h_px, w_px)
-            preview_shape = DataPreview.shape(
-                vo, sl, ch, h_px, w_px, s_px, l_px, c_px, ts)
-            preview_buffer = self._get_preview_buffer(preview_shape, 'uint16')
-            self.datapreview.get(data_buffer, s_px, l_px, c_px, ts,
-                                 allocated_memory=preview_buffer)
+                pf:, :, :].reshape(vo, sl, ch, h_px, w_px)
+            if self.channels_per_volume: # recorded 'tczyx' -> 'tzcyx' view
+                data_buffer = recorded_data.reshape(
+                    vo, ch, sl, h_px, w_px).transpose(0, 2, 1, 3, 4)
+            if streaming_preview:
+                previewer = self.camera # preview done, just release camera
+            else:
+                custody.switch_from(self.camera, to=self.datapreview)
+                preview_buffer = self._get_preview_buffer(
+                    preview_shape, 'uint16')
+                self.datapreview.get(recorded_data, s_px, l_px, c_px, ts,
+                                     allocated_memory=preview_buffer.reshape(
+                                         recorded_preview_shape),
+                                     preview_binning=pb,
+                                     preview_slice_step=ps,
+                                     bidirectional=self.bidirectional_scan)
+                previewer = self.datapreview
             if display:
-                custody.switch_from(self.datapreview, to=self.display)
+                custody.switch_from(previewer, to=self.display)
                 self.display.show_image(preview_buffer)
                 custody.switch_from(self.display, to=None)
             else:
-                custody.switch_from(self.datapreview, to=None)
+                custody.switch_from(previewer, to=None)
             if filename is not None:
-                data_path, preview_path = prepare_to_save_thread.get_result()
+                data_path, preview_path, metadata_path = (
+                    prepare_to_save_thread.get_result())
+                data_to_save = data_buffer
+                if crop == 'auto' and not preview_only:
+                    # Find the roi from the preview (no extra pass of the
+                    # raw data) and record it so coordinates can be
+                    # reconstructed, i.e. 'data[:, z0:z1, :, y0:y1, x0:x1]':
+                    try:
+                        roi = DataRoi().get_indices_from_preview(
+                            preview_buffer, sl, h_px, w_px, s_px, l_px, c_px,
+                            ts)
+                    except Exception as e: # don't lose the data, save it all
+                        roi = ((0, sl), (0, h_px), (0, w_px))
+                        if self.print_warnings:
+                            print("\n%s: ***WARNING***: crop='auto' "%(
+                                self.name) + "failed (%r)"%e)
+                            print("%s: -> saving the full volume"%self.name)
+                    (z0, z1), (y0, y1), (x0, x1) = roi
+                    if self.bidirectional_scan and vo > 1: # odd volumes:
+                        z0, z1 = min(z0, sl - z1), max(z1, sl - z0) # mirror
+                        roi = ((z0, z1), (y0, y1), (x0, x1))
+                    data_to_save = data_buffer[:, z0:z1, :, y0:y1, x0:x1]
+                    with open(metadata_path, 'a') as file:
+                        file.write('roi_zyx_px: ' + str(roi) + '\n')
+                        file.write('roi_shape: ' +
+                                   str(data_to_save.shape) + '\n')
                 if self.verbose:
                     print("%s: saving '%s'"%(self.name, data_path))
                     print("%s: saving '%s'"%(self.name, preview_path))
                 # TODO: consider puting FileSaving in a SubProcess
-                if not preview_only:
-                    imwrite(data_path, data_buffer, imagej=True)
+                if not preview_only and data_to_save.flags['C_CONTIGUOUS']:
+                    imwrite(data_path, data_to_save, imagej=True)
+                elif not preview_only: # a view, write image by image (no copy)
+                    imwrite(data_path,
+                            (data_to_save[i] for i in np.ndindex(
+                                data_to_save.shape[:3])),
+                            shape=data_to_save.shape,
+                            dtype=data_to_save.dtype,
+                            imagej=True)
                 imwrite(preview_path, preview_buffer, imagej=True)
                 if self.verbose:
                     print("%s: done saving."%self.name)
             self._release_data_buffer(data_buffer)
+            preview = None
+            if return_preview: # e.g. for 'DataZ', opt in (live mode copies)
+                preview = np.array(preview_buffer)
             self._release_preview_buffer(preview_buffer)
             del preview_buffer
+            return preview
         acquire_thread = ct.CustodyThread(
             target=acquire_task, first_resource=self.camera).start()
         self.unfinished_tasks.put(acquire_thread)
         return acquire_thread
 
+    def autofocus(self,
+                  z_um_target=None,      # None = estimate only, no move
+                  method='max_gradient', # see 'DataZ'
+                  gaussian_filter_std=3, # see 'DataZ'
+                  min_confidence=None,   # None = always trust the estimate
+                  display=False):        # Optional preview display
+        # Records a buffer with the current settings and returns the sample
+        # z position (um, see 'DataZ') from the preview in memory (first
+        # volume and channel), no files are written or read. If 'z_um_target'
+        # is given the focus piezo is moved to put the sample back there.
+        # If the estimate confidence (see 'DataZ.estimate_batch') is below
+        # 'min_confidence' the focus piezo is not moved and 'None' is returned.
+        # Use '.get_result()' on the returned thread to get the estimate
+        # (no need to 'finish_all_tasks()'):
+        assert method in ('max_intensity', 'max_gradient')
+        def autofocus_task(custody):
+            custody.switch_from(None, to=self.camera) # get camera
+            if not self._settings_applied:
+                if self.print_warnings:
+                    print("\n%s: ***WARNING***: settings not applied"%self.name)
+                    print("%s: -> please apply legal settings"%self.name)
+                    print("%s: (all arguments must be specified at least "%(
+                        self.name) + "once)")
+                custody.switch_from(self.camera, to=None)
+                return None
+            # We have custody of the camera so attribute access is safe:
+            vo   = self.volumes_per_buffer
+            sl   = self.slices_per_volume
+            ch   = len(self.channels_per_slice)
+            h_px = self.height_px
+            w_px = self.width_px
+            s_px = self.scan_step_size_px
+            l_px = self.preview_line_px
+            c_px = self.preview_crop_px
+            ts   = self.timestamp_mode
+            im   = self.images + self.camera_preframes
+            pf   = self.camera_preframes
+            voltages_key, voltages = self._voltages_key, self.voltages
+            old_images = self.camera.num_images
+            if self.channels_per_volume: # 'DataZ' only uses the 1st channel
+                # -> so only record the 1st channel volume (less photodose,
+                # and no filter moves needed):
+                vo, ch, im = 1, 1, sl + pf
+                voltages_key, voltages = self._get_voltages(
+                    first_volume_only=True)
+                self.camera.num_images = sl # see 'apply_settings'
+                self.filter_wheel.move(
+                    self._emission_filter_positions()[0], block=False)
+                self.filter_wheel._finish_moving()
+            data_buffer = self._get_data_buffer((im, h_px, w_px), 'uint16')
+            preview_buffer = self._get_preview_buffer( # full size for 'DataZ'
+                DataPreview.shape(vo, sl, ch, h_px, w_px, s_px, l_px, c_px, ts),
+                'uint16')
+            self._write_voltages(voltages_key, voltages) # if needed
+            camera_thread = ct.ResultThread(
+                target=self.camera.record_to_memory,
+                kwargs={'allocated_memory': data_buffer,
+                        'software_trigger': False},).start()
+            self.ao.play_voltages(block=False)
+            self._streaming_datapreview.get( # see 'acquire'
+                data_buffer[pf:, :, :].reshape(vo, sl, ch, h_px, w_px),
+                s_px, l_px, c_px, ts,
+                allocated_memory=preview_buffer,
+                frames_written=self._frames_written_counter(
+                    data_buffer, camera_thread, pf),
+                bidirectional=self.bidirectional_scan)
+            camera_thread.get_result()
+            self.camera.num_images = old_images
+            z_um, confidence = DataZ().estimate_batch(
+                preview_buffer[:1, :1], h_px, w_px, l_px, c_px, ts,
+                method, gaussian_filter_std)
+            z_um, confidence = float(z_um[0, 0]), float(confidence[0, 0])
+            if self.verbose:
+                print("%s: autofocus z_um = %0.3f (confidence = %0.1f)"%(
+                    self.name, z_um, confidence))
+            if min_confidence is not None and confidence < min_confidence:
+                if self.print_warnings:
+                    print("\n%s: ***WARNING***: autofocus confidence "%(
+                        self.name) + "%0.1f < %0.1f"%(
+                            confidence, min_confidence))
+                    print("%s: -> focus not changed"%self.name)
+                z_um = None
+            if z_um is not None and z_um_target is not None: # move back
+                self.focus_piezo.move_um(z_um - z_um_target, block=False)
+                self.focus_piezo._finish_moving()
+                self.focus_piezo_z_um = self.focus_piezo.z
+            if display:
+                custody.switch_from(self.camera, to=self.display)
+                self.display.show_image(preview_buffer)
+                custody.switch_from(self.display, to=None)
+            else:
+                custody.switch_from(self.camera, to=None)
+            self._release_data_buffer(data_buffer)
+            self._release_preview_buffer(preview_buffer)
+            del preview_buffer
+            return z_um
+        autofocus_thread = ct.CustodyThread(
+            target=autofocus_task, first_resource=self.camera).start()
+        self.unfinished_tasks.put(autofocus_thread)
+        return autofocus_thread
+
     def finish_all_tasks(self):
         collected_tasks = []
         while True:
@@ -741,6 +1198,58 @@ class Microscope:
         self.display.close()
         if self.verbose: print("%s: done closing."%self.name)
 
+class _Waveform:
+    # Compact ao voltages for 'Microscope': runs of constant voltages
+    # ('lengths_px' x 'values') for the active (non zero) ao channels only.
+    # Use 'chunks' to expand to the ao card format (px, num_channels) a
+    # bounded piece at a time, or 'to_array' for all of it:
+    def __init__(self, lengths_px, values, num_channels):
+        self.channels = np.flatnonzero(np.any(values != 0, axis=0))
+        self.values = np.ascontiguousarray(values[:, self.channels])
+        self.lengths_px = np.asarray(lengths_px, 'int64')
+        self.ends_px = np.cumsum(self.lengths_px)
+        self.num_channels = num_channels
+        total_px = int(self.ends_px[-1]) if len(self.ends_px) else 0
+        self.shape = (total_px, num_channels)
+        self.nbytes = self.lengths_px.nbytes + self.values.nbytes
+        self.dense_nbytes = 8 * total_px * num_channels
+
+    @staticmethod
+    def runs(array):
+        # Returns 'lengths_px, values' for a dense (px, channels) array:
+        change = np.flatnonzero(np.any(array[1:] != array[:-1], axis=1))
+        starts = np.concatenate(((0,), change + 1))
+        lengths_px = np.diff(np.append(starts, len(array)))
+        return lengths_px, array[starts]
+
+    @classmethod
+    def from_array(cls, array):
+        return cls(*cls.runs(array), array.shape[1])
+
+    def chunks(self, max_px=2**20):
+        # Yields dense (<= max_px, num_channels) arrays in order:
+        starts_px = self.ends_px - self.lengths_px
+        for a in range(0, self.shape[0], max_px):
+            b = min(a + max_px, self.shape[0])
+            i0 = np.searchsorted(self.ends_px, a, 'right') # runs in [a, b)
+            i1 = np.searchsorted(self.ends_px, b, 'left') + 1
+            lengths_px = (np.minimum(self.ends_px[i0:i1], b) -
+                          np.maximum(starts_px[i0:i1], a))
+            chunk = np.zeros((b - a, self.num_channels), 'float64')
+            chunk[:, self.channels] = np.repeat(
+                self.values[i0:i1], lengths_px, axis=0)
+            yield chunk
+
+    def to_array(self, max_px=2**20):
+        array = np.empty(self.shape, 'float64')
+        for i, chunk in enumerate(self.chunks(max_px)):
+            array[i * max_px:i * max_px + len(chunk)] = chunk
+        return array
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.to_array()
+        return array if dtype is None else array.astype(dtype)
+
 class _CustomNapariDisplay:
     def __init__(self, auto_contrast=False):
         self.auto_contrast = auto_contrast
@@ -807,10 +1316,110 @@ def calculate_cuboid_voxel_scan(voxel_aspect_ratio, scan_range_um):
     slices_per_volume = 1 + int(round(scan_range_um / scan_step_size_um))
     return scan_step_size_px, slices_per_volume # watch out for fencepost!
 
+@lru_cache(maxsize=None)
+def _preview_projections_kernel(binning):
+    # Returns a compiled kernel for 'DataPreview' with 'binning' as a compile
+    # time constant (so the inner loops vectorize for any binning):
+    @njit(nogil=True, cache=True)
+    def preview_projections(
+        data,           # raw 5D data 'tzcyx', C-contiguous
+        v,              # volume index
+        c,              # channel index
+        t_px,           # first (uncropped) row on the propagation axis
+        i_start,        # first (preview) slice to add to the projections
+        i_stop,         # last slice (exclusive), i.e. 'range(i_start, i_stop)'
+        slice_step,     # preview slice 'i' is raw slice 'i * slice_step'
+        reverse,        # True -> slices were recorded backwards
+        O1_shear_px,    # 1D int array, propagation axis shear per slice
+        width_shear_px, # 1D int array, scan axis shear per propagation pixel
+        O1_proj,        # 2D output, max accumulated in place
+        scan_proj,      # 2D output, max accumulated in place
+        width_proj):    # 2D output, max accumulated in place
+        # Streams through the raw data once (in memory order) and updates all
+        # 3 projections from each (max binned) pixel, rather than re-reading
+        # the whole volume for every projection. Slices can be added in
+        # several calls (e.g. while the camera is still recording).
+        prop_px, w_px = scan_proj.shape
+        row_px = w_px * binning
+        binned_rows = np.empty(row_px, data.dtype)
+        for i in range(i_start, i_stop):
+            O1_row_0 = O1_shear_px[i]
+            raw_i = i * slice_step
+            if reverse: raw_i = data.shape[1] - 1 - raw_i
+            for p in range(prop_px):
+                # Max bin rows (branch free loops on contiguous rows):
+                data_row_0 = t_px + p * binning
+                data_row = data[v, raw_i, c, data_row_0]
+                for x in range(row_px):
+                    binned_rows[x] = data_row[x]
+                for by in range(1, binning):
+                    data_row = data[v, raw_i, c, data_row_0 + by]
+                    for x in range(row_px):
+                        binned_rows[x] = max(binned_rows[x], data_row[x])
+                # Max bin columns and update projections:
+                O1_row = O1_proj[O1_row_0 + p]
+                scan_row = scan_proj[p]
+                width_max = binned_rows[0]
+                for x in range(w_px):
+                    value = binned_rows[x * binning]
+                    for bx in range(1, binning):
+                        value = max(value, binned_rows[x * binning + bx])
+                    O1_row[x] = max(O1_row[x], value)
+                    scan_row[x] = max(scan_row[x], value)
+                    width_max = max(width_max, value)
+                width_row = i + width_shear_px[p]
+                width_proj[width_row, p] = max(
+                    width_proj[width_row, p], width_max)
+    return preview_projections
+
+@njit(nogil=True, cache=True)
+def _preview_gather(source, rows, cols, out):
+    # Nearest pixel resampling for 'DataPreview' straight into 'out' (usually
+    # a view of the preview), i.e. 'out = source[rows[:, None], cols]':
+    for i in range(len(rows)):
+        source_row = source[rows[i]]
+        out_row = out[i]
+        for j in range(len(cols)):
+            out_row[j] = source_row[cols[j]]
+
+@njit(nogil=True, cache=True)
+def _roi_projections(
+    data,       # raw 5D data 'tzcyx', C-contiguous
+    t_px,       # crop top pixel rows
+    b_px,       # crop bottom pixel rows
+    scan_line,  # 3D 'tcz' output, max of each slice
+    scan_proj): # 4D 'tcyx' output, max accumulated in place
+    # One pass over the raw data for 'DataRoi' (in memory order):
+    vo, slices, ch, h_px, w_px = data.shape
+    for v in range(vo):
+        for i in range(slices):
+            for c in range(ch):
+                slice_max = data[v, i, c, t_px, 0]
+                for y in range(t_px, h_px - b_px):
+                    data_row = data[v, i, c, y]
+                    scan_row = scan_proj[v, c, y - t_px]
+                    for x in range(w_px):
+                        value = data_row[x]
+                        scan_row[x] = max(scan_row[x], value)
+                        slice_max = max(slice_max, value)
+                scan_line[v, c, i] = slice_max
+
 class DataPreview:
     # Returns 3 max intensity projections along the traditional XYZ axes. For
     # speed (and simplicity) these are calculated to the nearest pixel (without
     # interpolation) and should propably not be used for rigorous analysis.
+    def __init__(self, num_workers=None): # None = os.cpu_count()
+        # Each (volume, channel) is independent, and the compiled kernel
+        # releases the GIL, so a pool of threads can run them in parallel:
+        if num_workers is None: num_workers = os.cpu_count()
+        self.num_workers = num_workers
+        self._pool = ThreadPoolExecutor(max_workers=num_workers)
+        # Projection arrays are kept and reused while the geometry is the
+        # same (i.e. no new allocations when running continuously):
+        self._workspaces = []
+        self._workspaces_geometry = None
+        self._workspaces_lock = threading.Lock()
+
     @staticmethod
     def shape(volumes_per_buffer,
               slices_per_volume,
@@ -820,18 +1429,25 @@ class DataPreview:
               scan_step_size_px,
               preview_line_px,
               preview_crop_px,
-              timestamp_mode):
+              timestamp_mode,
+              preview_binning=1,    # max bin 'binning x binning' pixels
+              preview_slice_step=1):# only use every 'nth' slice
+        # A binned/decimated preview is the same as a full preview of smaller
+        # frames with a larger (relative) scan step:
+        pb, ps = preview_binning, preview_slice_step
+        slices = len(range(0, slices_per_volume, ps))
+        scan_step_size_px = scan_step_size_px * ps / pb
         # Calculate max pixel shear:
         scan_step_size_um = calculate_scan_step_size_um(scan_step_size_px)
         prop_px_per_scan_step = scan_step_size_um / ( # for an O1 axis view
             sample_px_um * np.cos(tilt))
         prop_px_shear_max = int(np.rint(
-            prop_px_per_scan_step * (slices_per_volume - 1)))
+            prop_px_per_scan_step * (slices - 1)))
         # Get image size with projections:
         t_px, b_px = 2 * (preview_crop_px,) # crop top and bottom pixel rows
         if timestamp_mode == "binary+ASCII": t_px = 8 # ignore timestamps
-        h_px = height_px - t_px - b_px
-        x_px = width_px
+        h_px = (height_px - t_px - b_px) // pb
+        x_px = width_px // pb
         y_px = int(round((h_px + prop_px_shear_max) * np.cos(tilt)))
         z_px = int(round(h_px * np.sin(tilt)))
         shape = (volumes_per_buffer,
@@ -840,87 +1456,222 @@ class DataPreview:
                  x_px + z_px + 2 * preview_line_px)
         return shape
 
+    @staticmethod
+    @lru_cache(maxsize=16) # live mode repeats the same geometry many times
+    def _geometry(slices_per_volume,
+                  height_px,
+                  width_px,
+                  scan_step_size_px,
+                  preview_crop_px,
+                  timestamp_mode,
+                  preview_binning,
+                  preview_slice_step):
+        # Kernel, shear tables and resampling indices for 'get' (read only):
+        def nearest_px(in_px, out_px): # same grid as 'zoom' with 'order=0'
+            if out_px < 2: return np.zeros(out_px, 'int64')
+            px = np.arange(out_px) * ((in_px - 1) / (out_px - 1))
+            return np.floor(px + 0.5).astype('int64')
+        pb, ps = preview_binning, preview_slice_step # see 'shape'
+        slices = len(range(0, slices_per_volume, ps))
+        scan_step_size_px = scan_step_size_px * ps / pb
+        width_px = width_px // pb
+        t_px, b_px = 2 * (preview_crop_px,) # crop top and bottom pixel rows
+        if timestamp_mode == "binary+ASCII": t_px = 8 # ignore timestamps
+        prop_px = (height_px - t_px - b_px) // pb # i.e. h_px (with cropping)
+        scan_step_size_um = calculate_scan_step_size_um(scan_step_size_px)
+        # Calculate max px shear on the propagation axis for an 'O1' projection:
+        # -> more shear than for a 'native' projection
+        prop_px_per_scan_step = scan_step_size_um / ( # O1 axis view
+            sample_px_um * np.cos(tilt))
+        prop_px_shear_max = int(np.rint(prop_px_per_scan_step * (slices - 1)))
+        # Calculate max px shear on the scan axis for a 'width' projection:
+        scan_steps_per_prop_px = 1 / prop_px_per_scan_step  # width axis view
+        scan_px_shear_max = int(np.rint(scan_steps_per_prop_px * (prop_px - 1)))
+        O1_shear_px = np.rint( # per slice
+            np.arange(slices) * prop_px_per_scan_step).astype('int64')
+        width_shear_px = np.rint( # per propagation pixel
+            np.arange(prop_px) * scan_steps_per_prop_px).astype('int64')
+        # Scale images according to pixel size (divide by X_px_um):
+        # -> X_px_um = sample_px_um (width axis)
+        # -> Y_px_um = sample_px_um * cos(tilt) (prop. axis to scan axis)
+        # -> Z_px_um = sample_px_um * sin(tilt) (prop. axis to O1 axis)
+        y_px = int(round((prop_px + prop_px_shear_max) * np.cos(tilt)))
+        z_px = int(round(prop_px * np.sin(tilt)))
+        geometry = {
+            'projections_kernel':_preview_projections_kernel(pb),
+            'slice_step':ps,
+            'slices':slices, # i.e. preview slices
+            'O1_proj_shape':(prop_px + prop_px_shear_max, width_px),
+            'scan_proj_shape':(prop_px, width_px),
+            'width_proj_shape':(slices + scan_px_shear_max, prop_px),
+            'O1_shear_px':O1_shear_px,
+            'width_shear_px':width_shear_px,
+            # Resampling indices are in the final (traditional) orientation:
+            # -> O1 and width images are flipped up/down, width left/right
+            'x_cols':np.arange(width_px),
+            'O1_rows':nearest_px(prop_px + prop_px_shear_max, y_px)[::-1],
+            'scan_rows':nearest_px(prop_px, z_px),
+            # width rows are scaled to match the O1 image (scan axis):
+            'width_rows':nearest_px(slices + scan_px_shear_max, y_px)[::-1],
+            'width_cols':nearest_px(prop_px, z_px)[::-1],
+            }
+        for v in geometry.values():
+            if isinstance(v, np.ndarray): v.flags.writeable = False
+        return geometry
+
     def get(self,
             data, # raw 5D data, 'tzcyx' input -> 'tcyx' output
             scan_step_size_px,
             preview_line_px,
             preview_crop_px,
             timestamp_mode,
-            allocated_memory=None):
+            allocated_memory=None,
+            preview_binning=1,   # see 'shape'
+            preview_slice_step=1,# see 'shape'
+            frames_written=None, # optional callable for streaming (see below)
+            poll_s=1e-3,
+            bidirectional=False):# True -> odd volumes were scanned backwards
         vo, slices, ch, h_px, w_px = data.shape
         s_px, l_px, c_px = scan_step_size_px, preview_line_px, preview_crop_px
+        pb, ps = preview_binning, preview_slice_step
         # Get preview shape and check allocated memory (or make new array):
-        preview_shape = self.shape(
-            vo, slices, ch, h_px, w_px, s_px, l_px, c_px, timestamp_mode)
+        preview_shape = self.shape(vo, slices, ch, h_px, w_px,
+                                   s_px, l_px, c_px, timestamp_mode, pb, ps)
         if allocated_memory is not None:
             assert allocated_memory.shape == preview_shape
             return_value = None # use given memory and avoid return
         else: # make new array and return
             allocated_memory = np.zeros(preview_shape, 'uint16')
             return_value = allocated_memory
-        t_px, b_px = 2 * (preview_crop_px,) # crop top and bottom pixel rows
+        t_px = preview_crop_px # crop top (and bottom) pixel rows
         if timestamp_mode == "binary+ASCII": t_px = 8 # ignore timestamps
-        prop_px = h_px - t_px - b_px # i.e. prop_px = h_px (with cropping)
-        data = data[:, :, :, t_px:h_px - b_px, :]
-        scan_step_size_um = calculate_scan_step_size_um(scan_step_size_px)
-        # Calculate max px shear on the propagation axis for an 'O1' projection:
-        # -> more shear than for a 'native' projection
-        prop_px_per_scan_step = scan_step_size_um / ( # O1 axis view
-            sample_px_um * np.cos(tilt))
-        prop_px_shear_max = int(np.rint(prop_px_per_scan_step * (slices - 1)))
-        # Calculate max px shear on the scan axis for a 'width' projection:
-        scan_steps_per_prop_px = 1 / prop_px_per_scan_step  # width axis view
-        scan_px_shear_max = int(np.rint(scan_steps_per_prop_px * (prop_px - 1)))
-        # Make projections:
+        if frames_written is not None: # must read the camera buffer itself
+            assert data.flags['C_CONTIGUOUS']
+        data = np.ascontiguousarray(data) # no copy for camera buffers
+        g = self._geometry( # cached, the geometry rarely changes
+            slices, h_px, w_px, s_px, c_px, timestamp_mode, pb, ps)
+        if frames_written is not None:
+            self._get_streaming(data, t_px, l_px, g, allocated_memory,
+                                frames_written, poll_s, bidirectional)
+            return return_value
+        # Make projections (in parallel for multiple volumes or channels):
+        vc = [(v, c) for v in range(vo) for c in range(ch)]
+        if self.num_workers > 1 and len(vc) > 1:
+            jobs = [self._pool.submit(
+                self._get_volume_channel, data, v, c, t_px, l_px, g,
+                allocated_memory, bidirectional and v % 2 == 1)
+                    for v, c in vc]
+            for job in jobs: job.result() # raises any exceptions
+        else:
+            for v, c in vc:
+                self._get_volume_channel(data, v, c, t_px, l_px, g,
+                                         allocated_memory,
+                                         bidirectional and v % 2 == 1)
+        return return_value
+
+    def _get_streaming(self, data, t_px, l_px, g, allocated_memory,
+                       frames_written, poll_s, bidirectional):
+        # Streaming mode: 'data' is still being written by the camera (in
+        # 'tzcyx' order) and 'frames_written()' returns the number of complete
+        # images. The projections are accumulated as each slice arrives, and
+        # each volume is rendered (in the pool) as soon as it's complete, so
+        # the preview is ready shortly after the last image.
+        vo, slices, ch = data.shape[:3]
+        ps, preview_slices = g['slice_step'], g['slices']
+        jobs = []
         for v in range(vo):
+            reverse = bidirectional and v % 2 == 1 # last slices arrive first
+            projections = [self._get_workspace(g) for c in range(ch)]
+            i_done = 0 # preview slices done (from the end if 'reverse')
+            while i_done < preview_slices:
+                # A slice is complete when all of its channels are written:
+                raw_ready = min(frames_written() // ch - v * slices, slices)
+                i_ready = -(-raw_ready // ps) # preview slice 'i' = 'i * ps'
+                if reverse: # preview slice 'i' = raw slice 'slices-1-i*ps'
+                    i_ready = preview_slices - (-(-(slices - raw_ready) // ps))
+                if i_ready <= i_done:
+                    time.sleep(poll_s)
+                    continue
+                i_range = (i_done, i_ready)
+                if reverse:
+                    i_range = (preview_slices - i_ready,
+                               preview_slices - i_done)
+                for c in range(ch):
+                    self._project(data, v, c, t_px, *i_range, g,
+                                  projections[c], reverse)
+                i_done = i_ready
             for c in range(ch):
-                O1_proj = np.zeros(
-                    (prop_px + prop_px_shear_max, w_px), 'uint16')
-                width_proj = np.zeros(
-                    (slices + scan_px_shear_max, prop_px), 'uint16')
-                max_width = np.amax(data[v, :, c, :, :], axis=2)
-                scan_proj = np.amax(data[v, :, c, :, :], axis=0)
-                for i in range(slices):
-                    prop_px_shear = int(np.rint(i * prop_px_per_scan_step))
-                    target = O1_proj[prop_px_shear:prop_px + prop_px_shear, :]
-                    np.maximum(target, data[v, i, c, :, :], out=target)
-                for i in range(prop_px):
-                    scan_px_shear = int(np.rint(i * scan_steps_per_prop_px))
-                    width_proj[scan_px_shear:slices + scan_px_shear, i] = (
-                        max_width[:, i])
-                # Scale images according to pixel size (divide by X_px_um):
-                X_px_um = sample_px_um # width axis
-                Y_px_um = sample_px_um * np.cos(tilt) # prop. axis to scan axis
-                Z_px_um = sample_px_um * np.sin(tilt) # prop. axis to O1 axis
-                O1_img    = zoom(
-                    O1_proj, (Y_px_um / X_px_um, 1), mode='nearest')
-                scan_img  = zoom(
-                    scan_proj, (Z_px_um / X_px_um, 1), mode='nearest')
-                scan_scale = O1_img.shape[0] / width_proj.shape[0]
-                # = scan_step_size_um / X_px_um rounded to match O1_img.shape[0]
-                width_img = zoom(
-                    width_proj, (scan_scale, Z_px_um / X_px_um), mode='nearest')
-                # Make image with all projections and flip for traditional view:
-                y_px, x_px = O1_img.shape
-                line_min, line_max = O1_img.min(), O1_img.max()
-                # Pass projections into allocated memory:
-                m = allocated_memory # keep code short!
-                m[v, c, l_px:y_px + l_px, l_px:x_px + l_px] = O1_img
-                m[v, c, y_px + 2*l_px:, l_px:x_px + l_px] = np.flipud(scan_img)
-                m[v, c, l_px:y_px + l_px, x_px + 2*l_px:] = np.fliplr(width_img)
-                m[v, c, y_px + 2*l_px:, x_px + 2*l_px:] = np.full(
-                    (scan_img.shape[0], width_img.shape[1]), 0)
-                # Add line separations between projections:
-                m[v, c, :l_px,    :] = line_max
-                m[v, c, :l_px, ::10] = line_min
-                m[v, c, y_px + l_px:y_px + 2*l_px,    :] = line_max
-                m[v, c, y_px + l_px:y_px + 2*l_px, ::10] = line_min
-                m[v, c, :,    :l_px] = line_max
-                m[v, c, ::10, :l_px] = line_min
-                m[v, c, :,    x_px + l_px:x_px + 2*l_px] = line_max
-                m[v, c, ::10, x_px + l_px:x_px + 2*l_px] = line_min
-                m[v, c, :] = np.flipud(m[v, c, :])
-        return return_value
+                jobs.append(self._pool.submit(
+                    self._render, v, c, l_px, g, projections[c],
+                    allocated_memory))
+        for job in jobs: job.result() # raises any exceptions
+        return None
+
+    def _get_workspace(self, g):
+        # Returns zeroed projection arrays for the geometry 'g':
+        with self._workspaces_lock:
+            if g is not self._workspaces_geometry: # new geometry, new arrays
+                self._workspaces = []
+                self._workspaces_geometry = g
+            if not self._workspaces:
+                return tuple(np.zeros(g[k], 'uint16') for k in (
+                    'O1_proj_shape', 'scan_proj_shape', 'width_proj_shape'))
+            projections = self._workspaces.pop()
+        for proj in projections: proj.fill(0)
+        return projections
+
+    def _release_workspace(self, g, projections):
+        with self._workspaces_lock:
+            if g is self._workspaces_geometry:
+                self._workspaces.append(projections)
+        return None
+
+    def _project(
+        self, data, v, c, t_px, i_start, i_stop, g, projections, reverse):
+        g['projections_kernel']( # single pass over the raw data
+            data, v, c, t_px, i_start, i_stop, g['slice_step'], reverse,
+            g['O1_shear_px'], g['width_shear_px'], *projections)
+        return None
+
+    def _get_volume_channel(
+        self, data, v, c, t_px, l_px, g, allocated_memory, reverse=False):
+        # Writes the preview for a single volume and channel (i.e. only into
+        # 'allocated_memory[v, c]'), so it's safe to call from parallel threads:
+        projections = self._get_workspace(g)
+        self._project(
+            data, v, c, t_px, 0, g['slices'], g, projections, reverse)
+        self._render(v, c, l_px, g, projections, allocated_memory)
+        return None
+
+    def _render(self, v, c, l_px, g, projections, allocated_memory):
+        # Writes the projections into 'allocated_memory[v, c]' in the final
+        # (traditional) orientation, then returns 'projections' for reuse:
+        O1_proj, scan_proj, width_proj = projections
+        y_px, z_px = len(g['O1_rows']), len(g['scan_rows'])
+        x_px = len(g['x_cols'])
+        m = allocated_memory[v, c] # keep code short!
+        h_px = m.shape[0]
+        # Scale projections according to pixel size (nearest pixel) and pass
+        # them into allocated memory:
+        # -> top: scan image | empty
+        # -> bottom: O1 image | width image
+        O1_img = m[z_px + l_px:z_px + l_px + y_px, l_px:x_px + l_px]
+        _preview_gather(
+            scan_proj, g['scan_rows'], g['x_cols'], m[:z_px, l_px:x_px + l_px])
+        m[:z_px, x_px + 2*l_px:] = 0
+        _preview_gather(O1_proj, g['O1_rows'], g['x_cols'], O1_img)
+        _preview_gather(width_proj, g['width_rows'], g['width_cols'],
+                        m[z_px + l_px:z_px + l_px + y_px, x_px + 2*l_px:])
+        self._release_workspace(g, projections)
+        # Add line separations between projections:
+        line_min, line_max = O1_img.min(), O1_img.max()
+        for line in (m[z_px:z_px + l_px], m[h_px - l_px:]): # rows
+            line[:] = line_max
+            line[:, ::10] = line_min
+        for line in (m[:, :l_px], m[:, x_px + l_px:x_px + 2*l_px]): # columns
+            line[:] = line_max
+            line[(h_px - 1) % 10::10] = line_min # dashes from the bottom up
+        return None
 
 class DataZ:
     # Can be used to estimate the z location of the sample in um relative to
@@ -950,13 +1701,248 @@ class DataZ:
         if method == 'max_intensity':
             max_z_intensity_um = np.argmax(intensity_line_smooth) * sample_px_um
             return max_z_intensity_um
-        intensity_gradient = np.zeros((len(intensity_line_smooth) - 1))
-        for px in range(len(intensity_line_smooth) - 1):
-            intensity_gradient[px] = (
-                intensity_line_smooth[px + 1] - intensity_line_smooth[px])
+        intensity_gradient = np.diff(intensity_line_smooth)
         max_z_gradient_um = np.argmax(intensity_gradient) * sample_px_um
         return max_z_gradient_um
 
+    def estimate_batch(
+        self,
+        preview, # 4D preview, 'tcyx' (all volumes and channels)
+        height_px,
+        width_px,
+        preview_line_px,
+        preview_crop_px,
+        timestamp_mode,
+        method='max_gradient',
+        gaussian_filter_std=3,
+        ):
+        # Returns 'z_um, confidence' arrays with shape (volumes, channels):
+        # - 'z_um' is fitted to subpixel precision (parabola through the peak)
+        # - 'confidence' is the peak height above the median of the line in
+        # units of robust noise (median absolute deviation), e.g. < ~5 means
+        # the peak is hard to tell from noise (no sample, too dim etc).
+        assert method in ('max_intensity', 'max_gradient')
+        t_px, b_px = 2 * (preview_crop_px,) # crop top and bottom pixel rows
+        if timestamp_mode == "binary+ASCII": t_px = 8 # ignore timestamps
+        h_px = height_px - t_px - b_px
+        z_px = int(round(h_px * np.sin(tilt))) # DataPreview definition
+        inspect_me = preview[:, :, :z_px, preview_line_px:width_px]
+        intensity_lines = np.average(inspect_me, axis=3)[:, :, ::-1]
+        lines = gaussian_filter1d(
+            intensity_lines, gaussian_filter_std, axis=2) # reject hot pixels
+        if method == 'max_gradient':
+            lines = np.diff(lines, axis=2)
+        # Peak and parabolic subpixel fit with neighbours (not at the ends):
+        px = np.argmax(lines, axis=2)[:, :, np.newaxis]
+        n = np.clip(px, 1, lines.shape[2] - 2)
+        y0, y1, y2 = (np.take_along_axis(lines, n + i, axis=2)[:, :, 0]
+                      for i in (-1, 0, 1))
+        curvature = y0 - 2 * y1 + y2
+        fit = (n[:, :, 0] == px[:, :, 0]) & (curvature < 0)
+        shift_px = 0.5 * (y0 - y2) / np.where(fit, curvature, -1)
+        z_um = (px[:, :, 0] + np.where(fit, shift_px, 0)) * sample_px_um
+        # Robust peak to noise ratio:
+        peak = np.take_along_axis(lines, px, axis=2)[:, :, 0]
+        median = np.median(lines, axis=2)
+        mad = np.median(np.abs(lines - median[:, :, np.newaxis]), axis=2)
+        noise = np.maximum(1.4826 * mad, np.finfo('float64').tiny)
+        confidence = (peak - median) / noise
+        return z_um, confidence
+
+class DriftTracker:
+    # Can be used to predict the focus drift at a list of positions from
+    # successive autofocus measurements (e.g. 'Microscope.autofocus' ->
+    # focus piezo z (um) that puts the sample back at its set point). The
+    # model is a drift shared by all positions (e.g. thermal, with a slowly
+    # changing rate) plus a slowly wandering offset per position, tracked
+    # with a Kalman filter. Use 'predict' to pre-apply the focus before each
+    # position and only autofocus when 'needs_measurement' (the prediction
+    # uncertainty is above 'max_std_um'), then 'update' with the result.
+    def __init__(
+        self,
+        positions,
+        measurement_std_um=0.5, # repeatability of the autofocus estimate
+        drift_rate_change_um_per_min=0.05, # shared drift rate random walk
+        position_drift_um_per_min=0.1,     # per position random walk
+        max_std_um=1,           # request a measurement above this
+        ):
+        assert max_std_um > measurement_std_um
+        self.positions = positions
+        self.measurement_std_um = measurement_std_um
+        self.drift_rate_change_um_per_min = drift_rate_change_um_per_min
+        self.position_drift_um_per_min = position_drift_um_per_min
+        self.max_std_um = max_std_um
+        # State: shared drift (um), shared drift rate (um/min) and the
+        # offset (um) of each position (unknown until measured):
+        self.state = np.zeros(2 + positions)
+        self.covariance = np.diag(
+            [0, 1] + positions * [1e6]).astype('float64')
+        self.measurements = np.zeros(positions, 'int64')
+        self.t_s = None
+
+    def _propagate(self, t_s):
+        # Returns the state and covariance at 't_s' (no changes to 'self'):
+        if self.t_s is None or t_s <= self.t_s:
+            return self.state, self.covariance
+        dt = (t_s - self.t_s) / 60 # minutes
+        F = np.eye(len(self.state))
+        F[0, 1] = dt
+        Q = np.zeros_like(self.covariance)
+        Q[:2, :2] = self.drift_rate_change_um_per_min**2 * np.array(
+            ((dt**3 / 3, dt**2 / 2),
+             (dt**2 / 2, dt       )))
+        Q[2:, 2:] = np.diag(
+            self.positions * [self.position_drift_um_per_min**2 * dt])
+        return F @ self.state, F @ self.covariance @ F.T + Q
+
+    def predict(self, position, t_s=None):
+        # Returns the predicted focus (um) and its std (um), or
+        # 'None, np.inf' if the position has never been measured:
+        if t_s is None: t_s = time.perf_counter()
+        if not self.measurements[position]:
+            return None, np.inf
+        state, covariance = self._propagate(t_s)
+        p = 2 + position
+        z_um = state[0] + state[p]
+        var = covariance[0, 0] + 2 * covariance[0, p] + covariance[p, p]
+        return z_um, np.sqrt(max(var, 0))
+
+    def needs_measurement(self, position, t_s=None):
+        return self.predict(position, t_s)[1] > self.max_std_um
+
+    def update(self, position, z_um, t_s=None):
+        # Folds in an autofocus measurement of the focus (um):
+        if t_s is None: t_s = time.perf_counter()
+        state, covariance = self._propagate(t_s)
+        H = np.zeros(len(state))
+        H[0], H[2 + position] = 1, 1
+        if not self.measurements[position]: # first: sets the offset only
+            state = state.copy()
+            state[2 + position] = z_um - state[0]
+        S = H @ covariance @ H + self.measurement_std_um**2
+        K = covariance @ H / S
+        state = state + K * (z_um - H @ state)
+        I_KH = np.eye(len(state)) - np.outer(K, H)
+        covariance = (I_KH @ covariance @ I_KH.T + # Joseph form (stable)
+                      np.outer(K, K) * self.measurement_std_um**2)
+        self.state, self.covariance, self.t_s = state, covariance, t_s
+        self.measurements[position] += 1
+        return None
+
+class FocusMap:
+    # Can be used to interpolate the focus (e.g. the focus piezo z (um) that
+    # puts the sample at its autofocus set point) at every XY position of a
+    # (large) position list from autofocus measurements at a few 'anchor'
+    # positions. Each time point: 'choose_anchors' -> autofocus at the
+    # anchors -> 'update' -> 'get' the focus for all positions. Anchors that
+    # were not re-measured are corrected for the drift shared by the
+    # re-measured anchors. Choose:
+    # - 'plane' for a tilted flat sample (e.g. coverslip)
+    # - 'thin_plate_spline' for a curved sample (needs more anchors)
+    # - 'auto' for 'thin_plate_spline' with >= 6 anchors, else 'plane'
+    def __init__(
+        self,
+        XY_stage_positions_mm, # list of (x, y) (or (x, y, 'absolute'))
+        method='auto',
+        smoothing=0,           # thin plate spline smoothing (0 = exact fit)
+        ):
+        assert method in ('auto', 'plane', 'thin_plate_spline')
+        self.xy_mm = np.array(
+            [xy[:2] for xy in XY_stage_positions_mm], 'float64')
+        self.method = method
+        self.smoothing = smoothing
+        positions = len(self.xy_mm)
+        self.z_um = np.full(positions, np.nan)  # latest measurement
+        self.round = np.full(positions, -1)     # ...and its time point
+        self._z_um_previous = np.full(positions, np.nan)
+        self._round_previous = np.full(positions, -1)
+        self.drift_um = []                      # shared drift per time point
+        self.loo_residual_um = np.zeros(positions) # leave one out errors
+
+    def _fit(self, xy_mm, z_um):
+        # Returns a function of xy_mm -> z_um:
+        n = len(z_um)
+        if n < 3: # not enough for a plane -> constant
+            return lambda xy: np.full(len(xy), np.mean(z_um))
+        A = np.column_stack((xy_mm, np.ones(n)))
+        collinear = np.linalg.matrix_rank(A) < 3 # e.g. 1 row of tiles/wells
+        if (self.method == 'plane' or collinear or
+            (self.method == 'auto' and n < 6)): # (spline would be singular)
+            coefficients = np.linalg.lstsq(A, z_um, rcond=None)[0]
+            return lambda xy: np.column_stack(
+                (xy, np.ones(len(xy)))) @ coefficients
+        return RBFInterpolator(xy_mm, z_um, kernel='thin_plate_spline',
+                               smoothing=self.smoothing, degree=1)
+
+    def _anchors(self):
+        # Returns the measured positions and their drift corrected focus:
+        R = len(self.drift_um) - 1
+        # Shared drift this time point from the re-measured anchors:
+        i = np.flatnonzero((self.round == R) & (self._round_previous >= 0))
+        drift_um = self.drift_um[-2] if R else 0.0
+        if len(i):
+            previous_um = (self._z_um_previous[i] + drift_um -
+                           np.array(self.drift_um)[self._round_previous[i]])
+            drift_um += np.median(self.z_um[i] - previous_um)
+        self.drift_um[-1] = drift_um
+        anchors = np.flatnonzero(self.round >= 0)
+        z_um = (self.z_um[anchors] + drift_um -
+                np.array(self.drift_um)[self.round[anchors]])
+        return anchors, z_um
+
+    def choose_anchors(self, number):
+        # Starts a new time point and returns the indices of the positions
+        # to measure: the worst predicted (largest leave one out error) and
+        # then the farthest from the others (coverage, oldest first):
+        if self.drift_um: self._anchors() # finish the last time point
+        self.drift_um.append(self.drift_um[-1] if self.drift_um else 0.0)
+        number = min(number, len(self.xy_mm))
+        order = np.argsort(-self.loo_residual_um, kind='stable')
+        chosen = [i for i in order[:number // 2]
+                  if self.loo_residual_um[i] > 0]
+        if not chosen: # start from the oldest (or never) measured position
+            chosen = [int(np.argmin(self.round))]
+        distance = np.min(np.linalg.norm(
+            self.xy_mm[:, np.newaxis] - self.xy_mm[chosen], axis=2), axis=1)
+        distance[chosen] = -1
+        while len(chosen) < number:
+            # farthest, then oldest if equal:
+            i = int(np.lexsort((self.round, -distance))[0])
+            chosen.append(i)
+            distance = np.minimum(
+                distance, np.linalg.norm(self.xy_mm - self.xy_mm[i], axis=1))
+            distance[chosen] = -1
+        return chosen
+
+    def update(self, position, z_um):
+        # Records an autofocus measurement (um) at 'position' (index):
+        if not self.drift_um: self.drift_um.append(0.0) # first time point
+        R = len(self.drift_um) - 1
+        if self.round[position] < R: # keep the last one (for drift)
+            self._z_um_previous[position] = self.z_um[position]
+            self._round_previous[position] = self.round[position]
+        self.z_um[position] = z_um
+        self.round[position] = R
+        return None
+
+    def get(self):
+        # Returns the focus (um) for all positions, or None if there are no
+        # measurements yet:
+        if not self.drift_um:
+            return None
+        anchors, z_um = self._anchors()
+        if not len(anchors):
+            return None
+        # Leave one out errors (worst predicted anchors are re-measured):
+        self.loo_residual_um[:] = 0
+        if len(anchors) > 3:
+            for j in range(len(anchors)):
+                others = np.arange(len(anchors)) != j
+                fit = self._fit(self.xy_mm[anchors[others]], z_um[others])
+                self.loo_residual_um[anchors[j]] = abs(
+                    fit(self.xy_mm[anchors[j:j + 1]])[0] - z_um[j])
+        return self._fit(self.xy_mm[anchors], z_um)(self.xy_mm)
+
 class DataRoi:
     # Can be used for cropping empty pixels from raw data. The SOLS microscope
     # produces vast amounts of data very quickly, often with many empty
@@ -971,110 +1957,603 @@ class DataRoi:
         signal_to_bg_ratio=1.2, # adjust for threshold
         gaussian_filter_std=3, # adjust for smoothing/hot pixel rejection
         ):
+        (z0, z1), (y0, y1), (x0, x1) = self.get_indices(
+            data, preview_crop_px, timestamp_mode,
+            signal_to_bg_ratio, gaussian_filter_std)
+        data_roi = data[:, z0:z1, :, y0:y1, x0:x1]
+        return data_roi # hopefully smaller!
+
+    def get_indices(
+        self,
+        data, # raw 5D data, 'tzcyx'
+        preview_crop_px,
+        timestamp_mode,
+        signal_to_bg_ratio=1.2, # adjust for threshold
+        gaussian_filter_std=3, # adjust for smoothing/hot pixel rejection
+        ):
+        # Returns the roi as ((z0, z1), (y0, y1), (x0, x1)) raw data indices,
+        # i.e. 'data[:, z0:z1, :, y0:y1, x0:x1]' (common to all volumes and
+        # channels):
         vo, slices, ch, h_px, w_px = data.shape
         t_px, b_px = 2 * (preview_crop_px,) # crop top and bottom pixel rows
         if timestamp_mode == "binary+ASCII": t_px = 8 # ignore timestamps
-        min_index_vo, max_index_vo = [], []
-        for v in range(vo):
-            min_index_ch, max_index_ch = [], []
-            for c in range(ch):
-                # Max project volume to images:
-                width_projection = np.amax(
-                    data[v, :, c, t_px:h_px - b_px, :], axis=2)
-                scan_projection  = np.amax(
-                    data[v, :, c, t_px:h_px - b_px, :], axis=0)
-                # Max project images to lines and smooth to reject hot pixels:
-                scan_line  = gaussian_filter1d(
-                    np.max(width_projection, axis=1), gaussian_filter_std)
-                prop_line  = gaussian_filter1d(
-                    np.max(scan_projection, axis=1), gaussian_filter_std)
-                width_line = gaussian_filter1d(
-                    np.max(scan_projection, axis=0), gaussian_filter_std)
-                # Find background level and set threshold:
-                scan_threshold  = int(min(scan_line)  * signal_to_bg_ratio)
-                prop_threshold  = int(min(prop_line)  * signal_to_bg_ratio)
-                width_threshold = int(min(width_line) * signal_to_bg_ratio)
-                # Estimate roi:.
-                min_index_zyx = [0, 0, 0]
-                max_index_zyx = [slices - 1, h_px - 1, w_px - 1]
-                for i in range(slices):
-                    if scan_line[i]  > scan_threshold:
-                        min_index_zyx[0] = i
-                        break
-                for i in range(h_px - t_px - b_px):
-                    if prop_line[i]  > prop_threshold:
-                        min_index_zyx[1] = i + t_px # put cropped pixels back
-                        break
-                for i in range(w_px):
-                    if width_line[i] > width_threshold:
-                        min_index_zyx[2] = i
-                        break        
-                for i in range(slices):
-                    if scan_line[-i] > scan_threshold:
-                        max_index_zyx[0] = max_index_zyx[0] - i
-                        break
-                for i in range(h_px - t_px - b_px):
-                    if prop_line[-i] > prop_threshold:
-                        max_index_zyx[1] = max_index_zyx[1] - i - b_px
-                        break
-                for i in range(w_px):
-                    if width_line[-i] > width_threshold:
-                        max_index_zyx[2] = max_index_zyx[2] - i
-                        break
-                min_index_ch.append(min_index_zyx)
-                max_index_ch.append(max_index_zyx)
-            min_index_vo.append(np.amin(min_index_ch, axis=0))
-            max_index_vo.append(np.amax(max_index_ch, axis=0))
-        min_i = np.amin(min_index_vo, axis=0)
-        max_i = np.amax(max_index_vo, axis=0)
-        data_roi = data[
-            :, min_i[0]:max_i[0], :, min_i[1]:max_i[1], min_i[2]:max_i[2]]
-        return data_roi # hopefully smaller!
+        # Max project volumes to lines (in one pass of the data):
+        scan_line = np.zeros((vo, ch, slices), data.dtype)
+        scan_proj = np.zeros((vo, ch, h_px - t_px - b_px, w_px), data.dtype)
+        _roi_projections(
+            np.ascontiguousarray(data), t_px, b_px, scan_line, scan_proj)
+        prop_line  = np.max(scan_proj, axis=3)
+        width_line = np.max(scan_proj, axis=2)
+        rows = np.arange(t_px, h_px - b_px) # put cropped pixels back
+        args = (signal_to_bg_ratio, gaussian_filter_std)
+        roi = (self._edges(scan_line, np.arange(slices), 1, slices, *args),
+               self._edges(prop_line, rows, 1, h_px, *args),
+               self._edges(width_line, np.arange(w_px), 1, w_px, *args))
+        return roi
+
+    def get_indices_from_preview(
+        self,
+        preview, # 4D 'tcyx' output of 'DataPreview.get' (same settings)
+        slices_per_volume,
+        height_px,
+        width_px,
+        scan_step_size_px,
+        preview_line_px,
+        preview_crop_px,
+        timestamp_mode,
+        preview_binning=1,
+        preview_slice_step=1,
+        signal_to_bg_ratio=1.2, # adjust for threshold
+        gaussian_filter_std=3, # adjust for smoothing/hot pixel rejection
+        ):
+        # Same as 'get_indices' but reads the (nearest pixel) projections back
+        # out of an existing preview, so the raw data is not read again. The
+        # lines are only sampled at the preview pixels, so the roi includes
+        # any unsampled pixels next to the edges:
+        pb, ps, l_px = preview_binning, preview_slice_step, preview_line_px
+        t_px, b_px = 2 * (preview_crop_px,) # crop top and bottom pixel rows
+        if timestamp_mode == "binary+ASCII": t_px = 8 # ignore timestamps
+        g = DataPreview._geometry(
+            slices_per_volume, height_px, width_px, scan_step_size_px,
+            preview_crop_px, timestamp_mode, pb, ps)
+        y_px, z_px = len(g['O1_rows']), len(g['scan_rows'])
+        x_px = len(g['x_cols'])
+        # Scan image -> propagation and width lines:
+        scan_img = preview[:, :, :z_px, l_px:x_px + l_px]
+        prop_line, rows = self._compact(
+            np.max(scan_img, axis=3), g['scan_rows'] * pb + t_px)
+        width_line, cols = self._compact(
+            np.max(scan_img, axis=2, initial=0), g['x_cols'] * pb)
+        if z_px == 0: # e.g. 'height_px=12', no scan image rows to sample
+            cols = cols[:0]
+        # Width image -> scan line (each pixel is from one preview slice):
+        width_img = preview[:, :, z_px + l_px:z_px + l_px + y_px,
+                            x_px + 2*l_px:]
+        i = (g['width_rows'][:, np.newaxis] -
+             g['width_shear_px'][g['width_cols']][np.newaxis, :])
+        valid = (i >= 0) & (i < g['slices'])
+        scan_line, slice_indices = self._compact(
+            width_img[:, :, valid], i[valid] * ps)
+        args = (signal_to_bg_ratio, gaussian_filter_std)
+        roi = (self._edges(
+                   scan_line, slice_indices, 1, slices_per_volume, *args),
+               self._edges(prop_line, rows, pb, height_px, *args),
+               self._edges(width_line, cols, pb, width_px, *args))
+        return roi
+
+    def _compact(self, values, indices):
+        # Max of 'values' (last axis) for each unique (sorted) index:
+        order = np.argsort(indices, kind='stable')
+        indices = indices[order]
+        starts = np.flatnonzero(np.diff(indices, prepend=-1))
+        line = np.maximum.reduceat(values[..., order], starts, axis=-1)
+        return line, indices[starts]
+
+    def _edges(
+        self,
+        line,       # 3D 'tc' + line, max projected data
+        indices,    # raw data index of each line pixel (increasing)
+        step_px,    # raw data pixels per line pixel (i.e. binning)
+        max_px,     # raw data pixels on this axis
+        signal_to_bg_ratio,
+        gaussian_filter_std):
+        # Smooth the lines to reject hot pixels, find the background level
+        # and set the threshold, then find the first and last line pixels
+        # above the threshold (for every volume and channel at once):
+        if len(indices) == 0: # nothing sampled, so keep the full range
+            return 0, max_px
+        px_per_line_px = (indices[-1] + step_px - indices[0]) / len(indices)
+        line = gaussian_filter1d(
+            line, gaussian_filter_std / px_per_line_px, axis=-1)
+        threshold = (np.min(line, axis=-1) * signal_to_bg_ratio).astype(int)
+        above = line > threshold[..., np.newaxis]
+        found = np.any(above, axis=-1)
+        first = np.argmax(above, axis=-1)
+        last = above.shape[-1] - 1 - np.argmax(above[..., ::-1], axis=-1)
+        # Unsampled raw pixels next to an edge are part of the roi:
+        starts = np.concatenate((indices[:1], indices[:-1] + step_px))
+        stops = np.concatenate((indices[1:], indices[-1:] + step_px))
+        i0 = np.where(found, starts[first], 0)
+        i1 = np.where(found, np.minimum(stops[last], max_px), max_px)
+        return int(np.min(i0)), int(np.max(i1))
 
 class DataNative:
     # The 'native view' is the most principled view of the data for analysis.
     # If 'type(scan_step_size_px) is int' (default) then no interpolation is
     # needed to view the volume. The native view looks at the sample with
     # the 'tilt' of the Snouty objective (microsope 3 in the emmission path).
+    @staticmethod
+    def shape(volumes_per_buffer,
+              slices_per_volume,
+              num_channels_per_slice, # = len(channels_per_slice)
+              height_px,
+              width_px,
+              scan_step_size_px):
+        prop_px_shear_max = int(np.rint(
+            (slices_per_volume - 1) * scan_step_size_px))
+        shape = (volumes_per_buffer,
+                 slices_per_volume,
+                 num_channels_per_slice,
+                 height_px + prop_px_shear_max,
+                 width_px)
+        return shape
+
     def get(
         self,
         data, # raw 5D data, 'tzcyx' input -> 'tzcyx' output
-        scan_step_size_px):
+        scan_step_size_px,
+        lazy=False, # True -> return a 'DataNativeView' (no copy)
+        out=None,   # optional array (e.g. np.memmap) with the output shape
+        path=None,  # optional filename -> output is a memory-mapped BigTIFF
+        bidirectional=False): # True -> odd volumes were scanned backwards
+        if lazy:
+            return DataNativeView(data, scan_step_size_px, bidirectional)
         vo, slices, ch, h_px, w_px = data.shape
-        prop_px = h_px # light-sheet propagation axis
-        scan_step_px_max = int(np.rint(scan_step_size_px * (slices - 1)))
-        data_native = np.zeros(
-            (vo, slices, ch, prop_px + scan_step_px_max, w_px), 'uint16')
+        prop_px_shear = np.rint( # per slice
+            np.arange(slices) * scan_step_size_px).astype('int64')
+        shape = self.shape(vo, slices, ch, h_px, w_px, scan_step_size_px)
+        if out is None and path is None:
+            data_native = np.zeros(shape, 'uint16')
+            if not bidirectional:
+                self._shear(data, prop_px_shear, data_native)
+            else: # put the slices of each volume in scan order
+                for v in range(vo):
+                    self._shear(_scan_order(data[v:v + 1], v), prop_px_shear,
+                                data_native[v:v + 1])
+            return data_native # larger!
+        if path is not None: # a new memory-mapped file is all zeros
+            assert out is None, 'use "out" or "path", not both'
+            out = memmap(path, shape=shape, dtype='uint16', bigtiff=True,
+                         metadata={'axes':'TZCYX'})
+        assert out.shape == shape, 'out.shape must be %s'%(shape,)
+        # Out-of-core: one volume and channel at a time keeps the working
+        # set small when 'data' and/or 'out' are memory-mapped:
         for v in range(vo):
             for c in range(ch):
-                for i in range(slices):
-                    prop_px_shear = int(np.rint(i * scan_step_size_px))
-                    data_native[
-                        v, i, c, prop_px_shear:prop_px + prop_px_shear, :] = (
-                            data[v, i, c, :, :])
-        return data_native # larger!
+                data_native_vc = out[v:v + 1, :, c:c + 1, :, :]
+                if path is None: data_native_vc[:] = 0
+                data_vc = data[v:v + 1, :, c:c + 1, :, :]
+                if bidirectional: data_vc = _scan_order(data_vc, v)
+                self._shear(data_vc, prop_px_shear, data_native_vc)
+        if hasattr(out, 'flush'): out.flush()
+        return out # larger!
+
+    def _shear(self, data, prop_px_shear, data_native):
+        prop_px = data.shape[3] # light-sheet propagation axis
+        # For an integer 'scan_step_size_px' (default) every slice is sheared
+        # by the same step, so a strided view of 'data_native' lines up with
+        # the raw data and the copy is a single call:
+        shear_steps = np.unique(np.diff(prop_px_shear))
+        if len(shear_steps) <= 1:
+            step_px = shear_steps[0] if len(shear_steps) == 1 else 0
+            st = data_native.strides
+            target = np.lib.stride_tricks.as_strided(
+                data_native,
+                shape=data.shape,
+                strides=(st[0], st[1] + step_px * st[3], st[2], st[3], st[4]))
+            target[:] = data
+        else: # uneven shear, copy all volumes and channels slice by slice:
+            for i in range(len(prop_px_shear)):
+                prop_px_shear_i = prop_px_shear[i]
+                data_native[
+                    :, i, :, prop_px_shear_i:prop_px + prop_px_shear_i, :] = (
+                        data[:, i, :, :, :])
+        return None
+
+def _scan_order(data, volume):
+    # For bidirectional scans: a 'tzcyx' view of 'volume' (i.e. 'data' is
+    # 'raw_data[volume:volume + 1]') with the slices in scan order:
+    return data[:, ::-1] if volume % 2 else data
+
+class DataNativeView:
+    # A lazy 'native view' of the raw data (see 'DataNative'). Only the raw
+    # data and the per slice shear are kept, and only the requested part of
+    # the native view is computed on indexing. This lets napari (or other
+    # analysis) browse the native view of multi-GB buffers without the
+    # 'larger!' copy:
+    def __init__(
+        self,
+        data, # raw 5D data, 'tzcyx'
+        scan_step_size_px,
+        bidirectional=False): # True -> odd volumes were scanned backwards
+        vo, slices, ch, h_px, w_px = data.shape
+        self.data = data
+        self.scan_step_size_px = scan_step_size_px
+        self.bidirectional = bidirectional
+        self.prop_px_shear = np.rint( # per slice
+            np.arange(slices) * scan_step_size_px).astype('int64')
+        self.shape = (
+            vo, slices, ch, h_px + int(self.prop_px_shear[-1]), w_px)
+        self.dtype = data.dtype
+        self.ndim = 5
+        self.size = int(np.prod(self.shape))
+        self.nbytes = self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data_native = DataNative().get(
+            self.data, self.scan_step_size_px, bidirectional=self.bidirectional)
+        if dtype is not None:
+            data_native = data_native.astype(dtype, copy=False)
+        return data_native
+
+    def __getitem__(self, key):
+        # Normalize 'key' to one index array per axis (ints, slices, lists
+        # and boolean masks are supported, several lists index each axis
+        # independently, i.e. 'np.ix_' style):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = (key[:i] + (slice(None),) * (self.ndim + 1 - len(key)) +
+                   key[i + 1:])
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for DataNativeView')
+        key = key + (slice(None),) * (self.ndim - len(key))
+        indices = [np.arange(n)[k] for n, k in zip(self.shape, key)]
+        is_int = [i.ndim == 0 for i in indices]
+        v_i, s_i, c_i, y_i, x_i = [np.atleast_1d(i) for i in indices]
+        out = np.zeros(
+            (len(v_i), len(s_i), len(c_i), len(y_i), len(x_i)), self.dtype)
+        if self.bidirectional: # odd volumes have their slices reversed
+            raw_slices = self.data.shape[1]
+            for n, v in enumerate(v_i):
+                raw_s_i = raw_slices - 1 - s_i if v % 2 else s_i
+                self._fill(out[n:n + 1], v_i[n:n + 1], s_i, raw_s_i,
+                           c_i, y_i, x_i)
+        else:
+            self._fill(out, v_i, s_i, s_i, c_i, y_i, x_i)
+        # Drop the axes indexed by an int (like numpy):
+        return out[tuple(0 if i else slice(None) for i in is_int)]
+
+    def _fill(self, out, v_i, s_i, raw_s_i, c_i, y_i, x_i):
+        # Fills 'out' slice by slice from the sheared raw rows ('s_i' are the
+        # native slices, 'raw_s_i' the matching raw slices):
+        h_px = self.data.shape[3]
+        v_k, c_k, x_k = _as_slice(v_i), _as_slice(c_i), _as_slice(x_i)
+        for j, (s, raw_s) in enumerate(zip(s_i, raw_s_i)):
+            rows = y_i - self.prop_px_shear[s]
+            valid = (rows >= 0) & (rows < h_px)
+            if not valid.any():
+                continue
+            y_k, r_k = _as_slice(np.flatnonzero(valid)), _as_slice(rows[valid])
+            keys = (v_k, raw_s, c_k, r_k, x_k)
+            out_j = out[:, j] # view
+            if all(isinstance(k, (slice, np.integer)) for k in keys):
+                out_j[:, :, y_k, :] = self.data[keys]
+            else:
+                out_j[:, :, y_k, :] = self.data[np.ix_(
+                    v_i, [raw_s], c_i, rows[valid], x_i)][:, 0]
+        return None
+
+def _as_slice(indices):
+    # A regularly spaced, increasing index array -> slice (no copy):
+    if len(indices) == 1:
+        return slice(indices[0], indices[0] + 1)
+    if len(indices) > 1:
+        step = indices[1] - indices[0]
+        if step > 0 and (np.diff(indices) == step).all():
+            return slice(indices[0], indices[-1] + 1, step)
+    return indices
 
 class DataTraditional:
     # Very slow but pleasing - rotates the native view to the traditional view!
+    @staticmethod
+    def shape(volumes_per_buffer,
+              slices_per_volume,
+              num_channels_per_slice, # = len(channels_per_slice)
+              height_px,              # of the native view (see 'DataNative')
+              width_px,
+              scan_step_size_px):
+        # Same as 'zoom' then 'rotate' (reshape=True) in 'get':
+        voxel_aspect_ratio = calculate_voxel_aspect_ratio(scan_step_size_px)
+        z_px = int(round(slices_per_volume * voxel_aspect_ratio))
+        angle_deg = np.rad2deg(tilt)
+        rot_matrix = np.array([[ cosdg(angle_deg), sindg(angle_deg)],
+                               [-sindg(angle_deg), cosdg(angle_deg)]])
+        out_bounds = rot_matrix @ [[0, 0, z_px, z_px],
+                                   [0, height_px, 0, height_px]]
+        z_px, y_px = (np.ptp(out_bounds, axis=1) + 0.5).astype(int)
+        shape = (volumes_per_buffer,
+                 int(z_px),
+                 num_channels_per_slice,
+                 int(y_px),
+                 width_px)
+        return shape
+
     def get(
         self,
         data_native, # raw 5D data, 'tzcyx' input -> 'tzcyx' output
-        scan_step_size_px):
+        scan_step_size_px,
+        out=None,   # optional array (e.g. np.memmap) with the output shape
+        path=None,  # optional filename -> output is a memory-mapped BigTIFF
+        engine='zoom_rotate', # or 'affine' -> faster, 1 interpolation
+        order=3,    # spline interpolation order (0-5)
+        dtype=None, # output dtype (e.g. 'float32'), default = input dtype
+        crop=None,  # 'affine' only, see 'crop_shape'
+        tile_px=None): # 'affine' only, (z, y) output tile -> bounded memory
+        assert engine in ('zoom_rotate', 'affine')
+        if engine == 'affine':
+            return self._get_affine(data_native, scan_step_size_px, False,
+                                    out, path, order, dtype, crop, tile_px)
+        assert crop is None and tile_px is None, 'use engine="affine"'
         vo, slices, ch, h_px, w_px = data_native.shape
+        shape = self.shape(vo, slices, ch, h_px, w_px, scan_step_size_px)
+        out = self._get_output(shape, out, path, dtype or data_native.dtype)
         voxel_aspect_ratio = calculate_voxel_aspect_ratio(scan_step_size_px)
-        tzcyx = []
+        # One volume and channel at a time, rotated straight into 'out':
         for v in range(vo):
-            zcyx = []
             for c in range(ch):
                 zyx_native_cubic_voxels = zoom(
-                    data_native[v, :, c, :, :], (voxel_aspect_ratio, 1, 1))
-                zyx_traditional = rotate(
-                    zyx_native_cubic_voxels, np.rad2deg(tilt))
-                zcyx.append(zyx_traditional[:, np.newaxis, : ,:])
-            zcyx = np.concatenate(zcyx, axis=1)
-            tzcyx.append(zcyx[np.newaxis, :, :, : ,:])
-        data_traditional = np.concatenate(tzcyx, axis=0)
-        return data_traditional # even larger!
+                    data_native[v, :, c, :, :], (voxel_aspect_ratio, 1, 1),
+                    output=out.dtype, order=order)
+                rotate(zyx_native_cubic_voxels, np.rad2deg(tilt),
+                       output=out[v, :, c, :, :], order=order)
+        if hasattr(out, 'flush'): out.flush()
+        return out # even larger!
+
+    def get_from_raw(
+        self,
+        data, # raw 5D data, 'tzcyx' input -> 'tzcyx' output
+        scan_step_size_px,
+        out=None,   # optional array (e.g. np.memmap) with the output shape
+        path=None,  # optional filename -> output is a memory-mapped BigTIFF
+        order=3,    # spline interpolation order (0-5)
+        dtype=None, # output dtype (e.g. 'float32'), default = input dtype
+        crop=None,  # see 'crop_shape'
+        tile_px=None): # (z, y) output tile -> bounded memory
+        # Skips the 'DataNative' intermediate: the shear is part of the
+        # affine transform (see 'get(..., engine="affine")'):
+        return self._get_affine(data, scan_step_size_px, True,
+                                out, path, order, dtype, crop, tile_px)
+
+    def crop_shape(
+        self,
+        data_shape, # 5D shape of the 'get' (native) or 'get_from_raw' data
+        scan_step_size_px,
+        raw=False,  # True -> 'data_shape' is for 'get_from_raw'
+        order=3,
+        crop=None): # None, 'occupied' or ((z0, z1), (y0, y1), (x0, x1))
+        # Legalizes 'crop' (in full output pixels) and returns it with the
+        # output shape. The full output is the rotated bounding box of the
+        # native view and mostly zeros, 'occupied' trims it to the bounding
+        # box of the (interpolated) data:
+        vo, slices, ch, h_px, w_px = data_shape
+        shape, matrix, offset, h_raw_px = self._geometry(
+            data_shape, scan_step_size_px, raw)
+        full = ((0, shape[1]), (0, shape[3]), (0, w_px))
+        if crop is None:
+            crop = full
+        elif crop == 'occupied':
+            m = mr = order + 1 # px, interpolation support
+            if not raw: # native zeros -> support across the sheared edges
+                if order > 1: m += 8 # + prefilter ringing
+                mr = m * (1 + scan_step_size_px)
+            z, r = np.meshgrid((-m, slices - 1 + m), (-mr, h_raw_px - 1 + mr))
+            if not raw: # raw coords -> native coords
+                r = r + scan_step_size_px * z
+            corners = np.linalg.inv(matrix) @ (
+                np.array((z.ravel(), r.ravel())) - offset[:, np.newaxis])
+            crop = ((int(np.floor(corners[0].min())),
+                     int(np.ceil(corners[0].max())) + 1),
+                    (int(np.floor(corners[1].min())),
+                     int(np.ceil(corners[1].max())) + 1),
+                    (0, w_px))
+        crop = tuple((max(int(c0), f0), min(int(c1), f1))
+                     for (c0, c1), (f0, f1) in zip(crop, full))
+        for (c0, c1) in crop:
+            assert c0 < c1, 'empty crop: %s'%(crop,)
+        (z0, z1), (y0, y1), (x0, x1) = crop
+        return crop, (vo, z1 - z0, ch, y1 - y0, x1 - x0)
+
+    def _get_affine(self, data, scan_step_size_px, raw,
+                    out, path, order, dtype, crop, tile_px):
+        shape, matrix, offset, h_raw_px = self._geometry(
+            data.shape, scan_step_size_px, raw)
+        crop, crop_shape = self.crop_shape(
+            data.shape, scan_step_size_px, raw, order, crop)
+        out = self._get_output(crop_shape, out, path, dtype or data.dtype)
+        self._transform(data, matrix, offset, out, order, crop, tile_px)
+        return out # even larger!
+
+    def _get_output(self, shape, out, path, dtype):
+        if path is not None:
+            assert out is None, 'use "out" or "path", not both'
+            out = memmap(path, shape=shape, dtype=dtype, bigtiff=True,
+                         metadata={'axes':'TZCYX'})
+        elif out is None:
+            out = np.empty(shape, dtype)
+        assert out.shape == shape, 'out.shape must be %s'%(shape,)
+        return out
+
+    def _geometry(self, data_shape, scan_step_size_px, raw):
+        # Full output shape, affine transform and raw data height:
+        vo, slices, ch, h_px, w_px = data_shape
+        if raw:
+            h_raw_px = h_px
+            h_px = DataNative.shape(
+                vo, slices, ch, h_px, w_px, scan_step_size_px)[3]
+        else:
+            h_raw_px = h_px - int(np.rint((slices - 1) * scan_step_size_px))
+        shape = self.shape(vo, slices, ch, h_px, w_px, scan_step_size_px)
+        matrix, offset = self._affine(
+            scan_step_size_px, slices, h_px, shape, raw)
+        return shape, matrix, offset, h_raw_px
+
+    def _affine(self, scan_step_size_px, slices, h_px, shape, raw):
+        # Compose 'zoom' (to cubic voxels) and 'rotate' (reshape=True) into
+        # one 'zy' affine transform (output coords -> native coords):
+        voxel_aspect_ratio = calculate_voxel_aspect_ratio(scan_step_size_px)
+        z_px = int(round(slices * voxel_aspect_ratio))
+        zoom_matrix = np.diag(( # same as 'zoom' (grid_mode=False)
+            (slices - 1) / (z_px - 1) if z_px > 1 else 1, 1))
+        angle_deg = np.rad2deg(tilt)
+        rot_matrix = np.array([[ cosdg(angle_deg), sindg(angle_deg)],
+                               [-sindg(angle_deg), cosdg(angle_deg)]])
+        out_center = rot_matrix @ ((np.array((shape[1], shape[3])) - 1) / 2)
+        in_center = (np.array((z_px, h_px)) - 1) / 2
+        matrix = zoom_matrix @ rot_matrix
+        offset = zoom_matrix @ (in_center - out_center)
+        if raw: # native coords -> raw coords (undo the 'DataNative' shear)
+            shear_matrix = np.array([[1, 0], [-scan_step_size_px, 1]])
+            matrix = shear_matrix @ matrix
+            offset = shear_matrix @ offset
+        return matrix, offset
+
+    def _transform(self, data, matrix, offset, out, order, crop, tile_px):
+        # 2D transforms of contiguous 'zy' planes (one per 'x' pixel), like
+        # 'rotate' but without the 'zoom' pass. The output is done in (z, y)
+        # tiles, and each tile only copies (and prefilters) the input region
+        # it needs + a margin for the spline support and prefilter:
+        vo, slices, ch, h_px, w_px = data.shape
+        (z0, z1), (y0, y1), (x0, x1) = crop
+        if tile_px is None: tile_px = (z1 - z0, y1 - y0)
+        if isinstance(tile_px, int): tile_px = (tile_px, tile_px)
+        margin_px = order + 1 + (8 if order > 1 else 0)
+        for v in range(vo):
+            for c in range(ch):
+                for tz0 in range(z0, z1, tile_px[0]):
+                    for ty0 in range(y0, y1, tile_px[1]):
+                        tz1 = min(tz0 + tile_px[0], z1)
+                        ty1 = min(ty0 + tile_px[1], y1)
+                        tile = (v, slice(tz0 - z0, tz1 - z0), c,
+                                slice(ty0 - y0, ty1 - y0), slice(None))
+                        # Input region for this tile:
+                        corners = matrix @ np.array(
+                            ((tz0, tz0, tz1 - 1, tz1 - 1),
+                             (ty0, ty1 - 1, ty0, ty1 - 1))) + offset[
+                                 :, np.newaxis]
+                        i0, j0 = np.floor(corners.min(axis=1)).astype(int)
+                        i1, j1 = np.ceil(corners.max(axis=1)).astype(int)
+                        i0, j0 = max(i0 - margin_px, 0), max(j0 - margin_px, 0)
+                        i1 = min(i1 + margin_px + 1, slices)
+                        j1 = min(j1 + margin_px + 1, h_px)
+                        if i0 >= i1 or j0 >= j1: # no data
+                            out[tile] = 0
+                            continue
+                        xzy = np.ascontiguousarray(np.moveaxis(
+                            data[v, i0:i1, c, j0:j1, x0:x1], 2, 0))
+                        tile_offset = (offset + matrix @ (tz0, ty0) -
+                                       (i0, j0))
+                        tile_shape = (tz1 - tz0, ty1 - ty0)
+                        xzy_out = np.empty(
+                            (x1 - x0,) + tile_shape, out.dtype)
+                        for x in range(x1 - x0):
+                            affine_transform(
+                                xzy[x], matrix, tile_offset, tile_shape,
+                                output=xzy_out[x], order=order)
+                        out[tile] = np.moveaxis(xzy_out, 0, 2)
+        if hasattr(out, 'flush'): out.flush()
+        return None
+
+class DataTraditionalPool:
+    # Runs 'DataTraditional' on (volume, channel) jobs in parallel
+    # subprocesses with shared memory for the job inputs and outputs (scipy's
+    # 'zoom', 'rotate' and 'affine_transform' only use one core). Use 'close'
+    # (or a 'with' block) to shut the subprocesses down when finished:
+    def __init__(
+        self,
+        num_workers=None,           # default = os.cpu_count()
+        max_bytes_in_flight=8e9):   # limits the number of active workers
+        if num_workers is None: num_workers = os.cpu_count()
+        self.max_bytes_in_flight = max_bytes_in_flight
+        init_threads = [ # subprocesses are slow to start, start in parallel
+            ct.ResultThread(
+                target=ct.ObjectInSubprocess, args=(DataTraditional,)).start()
+            for w in range(num_workers)]
+        self.workers = [th.get_result() for th in init_threads]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # Each 'ct.ObjectInSubprocess' shuts down its subprocess when it's
+        # garbage collected, so drop our (only) references to the workers:
+        self.workers.clear()
+        return None
+
+    def get(
+        self,
+        data,       # 5D 'native' data (or raw data if 'raw=True'), 'tzcyx'
+        scan_step_size_px,
+        raw=False,  # True -> 'DataTraditional.get_from_raw'
+        out=None,   # optional array (e.g. np.memmap) with the output shape
+        path=None,  # optional filename -> output is a memory-mapped BigTIFF
+        engine='affine', # see 'DataTraditional.get'
+        order=3,    # spline interpolation order (0-5)
+        dtype=None, # output dtype (e.g. 'float32'), default = input dtype
+        crop=None,  # 'affine' or 'raw' only, see 'DataTraditional.crop_shape'
+        tile_px=None): # 'affine' or 'raw' only, (z, y) output tile
+        vo, slices, ch, h_px, w_px = data.shape
+        dtype = np.dtype(dtype or data.dtype)
+        datatraditional = DataTraditional()
+        kwargs = {}
+        if raw or engine == 'affine':
+            crop, shape = datatraditional.crop_shape(
+                data.shape, scan_step_size_px, raw, order, crop)
+            kwargs = {'crop':crop, 'tile_px':tile_px}
+        else:
+            shape = DataTraditional.shape(*data.shape, scan_step_size_px)
+        out = datatraditional._get_output(shape, out, path, dtype)
+        # Each active worker reuses 1 shared input and output buffer:
+        job_in_shape = (1, slices, 1, h_px, w_px)
+        job_out_shape = (1, shape[1], 1, shape[3], shape[4])
+        job_bytes = (np.prod(job_in_shape) * data.dtype.itemsize +
+                     np.prod(job_out_shape) * dtype.itemsize)
+        num_workers = int(max(1, min(len(self.workers), vo * ch,
+                                     self.max_bytes_in_flight // job_bytes)))
+        jobs = queue.Queue()
+        for v in range(vo):
+            for c in range(ch):
+                jobs.put((v, c))
+        def work(worker):
+            job_in = ct.SharedNDArray(job_in_shape, data.dtype)
+            job_out = ct.SharedNDArray(job_out_shape, dtype)
+            while True:
+                try:
+                    v, c = jobs.get_nowait()
+                except queue.Empty:
+                    return None
+                job_in[0, :, 0, :, :] = data[v, :, c, :, :]
+                if raw:
+                    worker.get_from_raw(job_in, scan_step_size_px,
+                                        out=job_out, order=order, **kwargs)
+                else:
+                    worker.get(job_in, scan_step_size_px, out=job_out,
+                               engine=engine, order=order, **kwargs)
+                out[v, :, c, :, :] = job_out[0, :, 0, :, :]
+        work_threads = [
+            ct.ResultThread(target=work, args=(worker,)).start()
+            for worker in self.workers[:num_workers]]
+        for th in work_threads:
+            th.get_result()
+        if hasattr(out, 'flush'): out.flush()
+        return out # even larger!
 
 if __name__ == '__main__':
     t0 = time.perf_counter()
@@ -2,14 +2,13 @@ import time
 import os
 import numpy as np
 from datetime import datetime
-from tifffile import imread, imwrite
+from tifffile import imwrite
 
 import sols_microscope as sols
 
 if __name__ == '__main__': # required block for sols_microscope
     # Create scope:
     scope = sols.Microscope(max_allocated_bytes=100e9, ao_rate=1e4)
-    dataz = sols.DataZ() # create postprocessor for software autofocus
 
     # Apply settings at least once: (required)
     scope.apply_settings(
@@ -58,6 +57,16 @@ if __name__ == '__main__': # required block for sols_microscope
     # Get number of positions:
     assert len(focus_piezo_positions) == len(XY_stage_positions)
     positions = len(XY_stage_positions)
+    z_um_0 = positions * [None] # autofocus set points (from first previews)
+    dataz = sols.DataZ()
+    # Predict the focus drift and only autofocus when uncertain:
+    drift_tracker = sols.DriftTracker(positions, max_std_um=1)
+    # Or for large position lists, autofocus only a few 'anchor' positions
+    # per time point and interpolate the rest (needs 'absolute' XY):
+    focus_map_anchors = None # e.g. 8 (or None to autofocus every position)
+    focus_map = None
+    if focus_map_anchors is not None:
+        focus_map = sols.FocusMap(XY_stage_positions, method='auto')
 
     # Make folder name for data:
     folder_label = 'sols_acquisition_template'  # edit name to preference
@@ -87,9 +96,18 @@ if __name__ == '__main__': # required block for sols_microscope
         # start timer:
         t0 = time.perf_counter()
         scope.snoutfocus() # apply thermal stabilization routine
+        if focus_map is not None:
+            focus_map_z_um = focus_map.get() # None until first anchors
+            anchors = focus_map.choose_anchors(focus_map_anchors)
         for p in range(positions):
             # Move to XYZ position:
             # -> also applies 'z_change_um' for software autofocus (if active)
+            # -> and the predicted drift since the last autofocus:
+            z_um_predicted, z_std_um = drift_tracker.predict(p)
+            if z_um_predicted is not None:
+                focus_piezo_positions[p] = [z_um_predicted, 'absolute']
+            if focus_map is not None and focus_map_z_um is not None:
+                focus_piezo_positions[p] = [focus_map_z_um[p], 'absolute']
             scope.apply_settings(focus_piezo_z_um=focus_piezo_positions[p],
                                  XY_stage_position_mm=XY_stage_positions[p])
             if full_acquire: # set setting and acquire:
@@ -106,10 +124,11 @@ if __name__ == '__main__': # required block for sols_microscope
                     scan_range_um=100,
                     volumes_per_buffer=1,
                     )
-                scope.acquire(filename=filename488,
-                              folder_name=folder_name,
-                              description='488 something...',
-                              preview_only=False)
+                acquire488 = scope.acquire(filename=filename488,
+                                           folder_name=folder_name,
+                                           description='488 something...',
+                                           preview_only=False,
+                                           return_preview=True)
                 # 561 example:
                 filename561 = '561_%06i_%06i.tif'%(current_time_point, p)
                 scope.apply_settings(
@@ -125,13 +144,32 @@ if __name__ == '__main__': # required block for sols_microscope
                               folder_name=folder_name,
                               description='561 something...',
                               preview_only=False)
-            # Software autofocus (optional):
             else:
-                print('-> autofocus acquisition (position:%i)'%p)
-                # 488 autofocus example:
-                filename488 = 'af488_%06i_%06i_%06i.tif'%(
-                    (current_time_point - 1), p, current_autofocus_point)
-                # trim down settings for increased speed/reduced photodose:
+                print('-> autofocus only (position:%i)'%p)
+            # Software autofocus:
+            # -> skip if not an anchor position (focus map):
+            if focus_map is not None and p not in anchors:
+                print('-> autofocus skipped (focus map)\n')
+                continue
+            # -> skip if the drift prediction is good enough:
+            if focus_map is None and not drift_tracker.needs_measurement(p):
+                print('-> autofocus skipped (predicted std um: %0.3f)\n'%(
+                    z_std_um))
+                continue
+            # -> 'None' if the estimate is not confident (e.g. no sample in
+            # the FOV), then the focus is left unchanged:
+            if full_acquire: # re-use the 488 preview (no extra photodose):
+                preview = acquire488.get_result() # 1 vol, 1 ch
+                z_um, confidence = dataz.estimate_batch( # as 'autofocus'
+                    preview[:1, :1],
+                    scope.height_px,
+                    scope.width_px,
+                    scope.preview_line_px,
+                    scope.preview_crop_px,
+                    scope.timestamp_mode)
+                z_um = float(z_um[0, 0]) if confidence[0, 0] >= 5 else None
+            else:
+                # -> trim down settings for increased speed/reduced photodose:
                 scope.apply_settings(
                     channels_per_slice=('488',),
                     power_per_channel=(1,),
@@ -141,28 +179,21 @@ if __name__ == '__main__': # required block for sols_microscope
                     scan_range_um=100,
                     volumes_per_buffer=1,
                     )
-                scope.acquire(filename=filename488,
-                              folder_name=folder_name,
-                              description='488 autofocus',
-                              preview_only=True)
-            # run autofocus routine:
-            scope.finish_all_tasks() # must finish before looking at preview!
-            autofocus_filename = filename488 # which filename for autofocus?
-            preview = imread( # 1 2D image from preview! (1 vol, 1 ch)
-                folder_name + '\preview\\' + autofocus_filename)
-            z_um = dataz.estimate(preview, # parameters must match preview file!
-                                  scope.height_px,
-                                  scope.width_px,
-                                  scope.preview_line_px,
-                                  scope.preview_crop_px,
-                                  scope.timestamp_mode)
-            if i == 0: # get set point for z from first preview (set by user)
-                z_um_0 = z_um
-            z_change_um = z_um - z_um_0
+                # -> estimate from the preview in memory (no files, and only
+                # waits for this task, not 'finish_all_tasks()'):
+                z_um = scope.autofocus(min_confidence=5).get_result()
+            if z_um is None:
+                continue
+            if z_um_0[p] is None: # get set point from first preview (user)
+                z_um_0[p] = z_um
+            z_change_um = z_um - z_um_0[p]
             print('Sample z-axis change um: %0.3f\n'%z_change_um)
             # update focus piezo positions with measured drift:
             focus_piezo_positions[p] = [scope.focus_piezo_z_um + z_change_um,
                                         'absolute']
+            drift_tracker.update(p, focus_piezo_positions[p][0])
+            if focus_map is not None:
+                focus_map.update(p, focus_piezo_positions[p][0])
         # finish timing and increment time point if applicable:
         loop_time_s = time.perf_counter() - t0
         if full_acquire:
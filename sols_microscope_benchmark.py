@@ -0,0 +1,212 @@
+# Imports from the python standard library:
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+
+# Third party imports, installable via pip:
+import numpy as np
+
+# Our code, one .py file per module, copy files to your local directory:
+import sols_microscope as sols # no hardware needed for the data classes
+
+camera_gb_per_s = 1 # approximate data rate of the camera (pco_edge42_cl)
+
+def make_data(volumes, slices, channels, height_px, width_px, seed=0):
+    # Synthetic raw 'tzcyx' data: camera offset + noise + a central 'sample'
+    rng = np.random.default_rng(seed)
+    data = rng.integers(
+        90, 110, (volumes, slices, channels, height_px, width_px), 'uint16')
+    s0, s1 = slices // 4, 3 * slices // 4
+    h0, h1 = height_px // 4, 3 * height_px // 4
+    w0, w1 = width_px // 4, 3 * width_px // 4
+    data[:, s0:s1, :, h0:h1, w0:w1] += rng.integers(
+        0, 1000, (volumes, s1 - s0, channels, h1 - h0, w1 - w0), 'uint16')
+    return data
+
+def time_it(function, repeats):
+    # Returns the best time (s) and the peak traced memory (bytes):
+    function() # warm up (e.g. numba compilation and caches)
+    times_s = []
+    tracemalloc.start()
+    for r in range(repeats):
+        tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        function()
+        times_s.append(time.perf_counter() - t0)
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times_s), peak_bytes
+
+def run(settings,                   # list of dicts (see '__main__')
+        processors=('DataPreview',
+                    'DataNative',
+                    'DataTraditional',
+                    'DataTraditional_affine',
+                    'DataTraditional_raw',
+                    'DataTraditional_occupied',
+                    'DataTraditionalPool',
+                    'DataRoi',
+                    'DataRoi_preview',
+                    'DataZ',
+                    'DataZ_batch'),
+        repeats=3,
+        traditional_max_bytes=100e6,# skip slow DataTraditional runs
+        preview_line_px=10,
+        preview_crop_px=3,
+        timestamp_mode='binary+ASCII',
+        verbose=True):
+    l_px, c_px, ts = preview_line_px, preview_crop_px, timestamp_mode
+    datapreview = sols.DataPreview()
+    datanative  = sols.DataNative()
+    datatraditional = sols.DataTraditional()
+    dataroi = sols.DataRoi()
+    dataz = sols.DataZ()
+    datatraditionalpool = None # subprocesses, only start if needed
+    if 'DataTraditionalPool' in processors:
+        datatraditionalpool = sols.DataTraditionalPool()
+    results = []
+    for s in settings:
+        s_px, slices = sols.calculate_cuboid_voxel_scan(
+            s['voxel_aspect_ratio'], s['scan_range_um'])
+        h_px, w_px, ch = s['height_px'], s['width_px'], s['channels']
+        data = make_data(1, slices, ch, h_px, w_px)
+        raw_bytes = data.nbytes
+        preview = datapreview.get(data, s_px, l_px, c_px, ts)
+        native = datanative.get(data, s_px)
+        tests = {
+            'DataPreview':lambda: datapreview.get(
+                data, s_px, l_px, c_px, ts, allocated_memory=preview),
+            'DataNative':lambda: datanative.get(data, s_px),
+            'DataTraditional':lambda: datatraditional.get(native, s_px),
+            'DataTraditional_affine':lambda: datatraditional.get(
+                native, s_px, engine='affine'),
+            'DataTraditional_raw':lambda: datatraditional.get_from_raw(
+                data, s_px),
+            'DataTraditional_occupied':lambda: datatraditional.get_from_raw(
+                data, s_px, crop='occupied'),
+            'DataTraditionalPool':lambda: datatraditionalpool.get(
+                data, s_px, raw=True),
+            'DataRoi':lambda: dataroi.get(data, c_px, ts),
+            'DataRoi_preview':lambda: dataroi.get_indices_from_preview(
+                preview, slices, h_px, w_px, s_px, l_px, c_px, ts),
+            'DataZ':lambda: dataz.estimate(
+                preview[0, 0], h_px, w_px, l_px, c_px, ts),
+            'DataZ_batch':lambda: dataz.estimate_batch(
+                preview, h_px, w_px, l_px, c_px, ts),
+            }
+        for name in processors:
+            result = dict(s, processor=name,
+                          slices_per_volume=slices,
+                          scan_step_size_px=s_px,
+                          raw_bytes=raw_bytes)
+            if (name.startswith('DataTraditional') and
+                raw_bytes > traditional_max_bytes):
+                result['skipped'] = True
+            else:
+                try:
+                    time_s, peak_bytes = time_it(tests[name], repeats)
+                except Exception as e: # record it and finish the sweep
+                    tracemalloc.stop()
+                    result['error'] = repr(e)
+                    results.append(result)
+                    if verbose: print_result(result)
+                    continue
+                gb_per_s = 1e-9 * raw_bytes / time_s
+                result.update(time_s=time_s,
+                              gb_per_s=gb_per_s,
+                              camera_ratio=gb_per_s / camera_gb_per_s,
+                              peak_bytes=peak_bytes,
+                              peak_raw_ratio=peak_bytes / raw_bytes)
+            results.append(result)
+            if verbose: print_result(result)
+    if datatraditionalpool is not None:
+        datatraditionalpool.close()
+    return results
+
+def print_result(result):
+    settings = '%4i x %4i px, %2i var, %3i um, %i ch'%(
+        result['height_px'], result['width_px'], result['voxel_aspect_ratio'],
+        result['scan_range_um'], result['channels'])
+    if result.get('skipped'):
+        print('%-24s %s: skipped'%(result['processor'], settings))
+        return None
+    if 'error' in result:
+        print('%-24s %s: error %s'%(
+            result['processor'], settings, result['error']))
+        return None
+    print('%-24s %s: %8.4fs %7.2fGB/s (%6.2fx camera) peak %7.1fMB'%(
+        result['processor'], settings, result['time_s'], result['gb_per_s'],
+        result['camera_ratio'], 1e-6 * result['peak_bytes']))
+    return None
+
+def save(results, filename):
+    def git_commit():
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+                ).stdout.strip()
+        except OSError:
+            return None
+    to_save = {
+        'Date':datetime.strftime(datetime.now(),'%Y-%m-%d'),
+        'Time':datetime.strftime(datetime.now(),'%H:%M:%S'),
+        'git_commit':git_commit(),
+        'python':platform.python_version(),
+        'numpy':np.__version__,
+        'machine':platform.platform(),
+        'cpu_count':os.cpu_count(),
+        'camera_gb_per_s':camera_gb_per_s,
+        'results':results,
+        }
+    with open(filename, 'w') as file:
+        json.dump(to_save, file, indent=1)
+    return None
+
+def compare(old_filename, new_filename):
+    # Prints the speed up (old time / new time) for matching results:
+    def key(r):
+        return (r['processor'], r['height_px'], r['width_px'],
+                r['voxel_aspect_ratio'], r['scan_range_um'], r['channels'])
+    with open(old_filename) as file: old = json.load(file)
+    with open(new_filename) as file: new = json.load(file)
+    old_results = {key(r):r for r in old['results'] if 'time_s' in r}
+    print('%s (%s) -> %s (%s):'%(old_filename, old['git_commit'],
+                                 new_filename, new['git_commit']))
+    for r in new['results']:
+        if 'time_s' not in r or key(r) not in old_results: continue
+        o = old_results[key(r)]
+        print('%-24s %4i x %4i px, %2i var, %3i um, %i ch: '%key(r) +
+              'speed up %6.2fx, peak memory %6.2fx'%(
+                  o['time_s'] / r['time_s'],
+                  r['peak_bytes'] / max(o['peak_bytes'], 1)))
+    return None
+
+if __name__ == '__main__':
+    # Sweep the typical ranges from 'sols_microscope_acquisition_template.py'
+    # one setting at a time around a base setting (edit as needed):
+    base = {'height_px':100,         # 12 -> 500  (typical range)
+            'width_px':512,          # 60 -> 1020 (typical range)
+            'voxel_aspect_ratio':2,  # 2  -> 10   (typical range)
+            'scan_range_um':50,      # 10 -> 100  (typical range)
+            'channels':1}            # 1  -> 4
+    sweep = {'height_px':(12, 50, 100, 250, 500),
+             'width_px':(60, 256, 512, 1020),
+             'voxel_aspect_ratio':(2, 5, 10),
+             'scan_range_um':(10, 50, 100),
+             'channels':(1, 2, 4)}
+    settings = [base]
+    for k, values in sweep.items():
+        for v in values:
+            if v != base[k]: settings.append(dict(base, **{k:v}))
+    results = run(settings, repeats=3)
+    # Save for comparing versions, e.g. compare(old_filename, new_filename):
+    if not os.path.exists('sols_benchmarks'): os.makedirs('sols_benchmarks')
+    dt = datetime.strftime(datetime.now(),'%Y-%m-%d_%H-%M-%S')
+    filename = os.path.join('sols_benchmarks', dt + '_sols_benchmark.json')
+    save(results, filename)
+    print('saved:', filename)
@@ -470,7 +470,7 @@ class GuiMicroscope:
         if self.volumes_per_buffer.value.get() != 1:
             self.volumes_per_buffer.update_and_validate(1)
         self.last_acquire_task.get_result() # don't accumulate
-        self.last_acquire_task = self.scope.acquire()
+        self.last_acquire_task = self.scope.acquire(streaming_preview=True)
         return None
 
     def init_focus_piezo(self):
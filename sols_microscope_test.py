@@ -0,0 +1,233 @@
+# Third party imports, installable via pip:
+import numpy as np
+from scipy.ndimage import zoom
+
+# Our code, one .py file per module, copy files to your local directory:
+import sols_microscope as sols # no hardware needed for the data classes
+
+def make_data(volumes, slices, channels, height_px, width_px, seed=0):
+    # Synthetic raw 'tzcyx' data: camera offset + noise + a central 'sample'
+    rng = np.random.default_rng(seed)
+    data = rng.integers(
+        90, 110, (volumes, slices, channels, height_px, width_px), 'uint16')
+    s0, s1 = slices // 4, 3 * slices // 4
+    h0, h1 = height_px // 4, 3 * height_px // 4
+    w0, w1 = width_px // 4, 3 * width_px // 4
+    data[:, s0:s1, :, h0:h1, w0:w1] += rng.integers(
+        0, 1000, (volumes, s1 - s0, channels, h1 - h0, w1 - w0), 'uint16')
+    return data
+
+def make_microscope(**settings):
+    # A 'Microscope' with just enough attributes for '_calculate_voltages'
+    # (no hardware):
+    class AO:
+        num_channels = 30
+        def s2p(self, seconds): return int(round(seconds * 1e5))
+        def p2s(self, px): return px / 1e5
+    scope = object.__new__(sols.Microscope)
+    scope.ao = AO()
+    scope.names_to_voltage_channels = {
+        'camera':0, 'galvo':4, 'LED_power':12, '488_TTL':20, '488_power':21,
+        '561_TTL':24, '561_power':25}
+    scope.camera = type('Camera', (), {})()
+    scope.camera.exposure_us, scope.camera.rolling_time_us = 1100, 1000
+    defaults = {'channels_per_slice':('488', '561'),
+                'power_per_channel':(5, 10),
+                'emission_filter':'Open',
+                'scan_range_um':50,
+                'slices_per_volume':10,
+                'volumes_per_buffer':3,
+                'camera_preframes':1,
+                'bidirectional_scan':False,
+                'galvo_flyback_us':0,
+                'inter_volume_delay_s':0,
+                'channels_per_volume':False,
+                'filter_wheel_move_s':0.1}
+    for k, v in dict(defaults, **settings).items(): setattr(scope, k, v)
+    return scope
+
+def dense_voltages(scope):
+    # Reference: the original one period at a time '_calculate_voltages'
+    n2c = scope.names_to_voltage_channels
+    exposure_px = scope.ao.s2p(1e-6 * scope.camera.exposure_us)
+    rolling_px = scope.ao.s2p(1e-6 * scope.camera.rolling_time_us)
+    jitter_px = max(scope.ao.s2p(30e-6), 1)
+    period_px = max(exposure_px, rolling_px) + jitter_px
+    galvo_scan_volts = 4.5 / 110 * scope.scan_range_um
+    galvo_voltages = np.linspace(
+        - galvo_scan_volts/2, galvo_scan_volts/2, scope.slices_per_volume)
+    voltages = []
+    for frames in range(scope.camera_preframes):
+        v = np.zeros((period_px, scope.ao.num_channels), 'float64')
+        v[:rolling_px, n2c['camera']] = 5
+        voltages.append(v)
+    for volumes in range(scope.volumes_per_buffer):
+        for _slice in range(scope.slices_per_volume):
+            for channel, power in zip(scope.channels_per_slice,
+                                      scope.power_per_channel):
+                v = np.zeros((period_px, scope.ao.num_channels), 'float64')
+                v[:rolling_px, n2c['camera']] = 5
+                v[:, n2c['galvo']] = galvo_voltages[_slice]
+                if channel != 'LED':
+                    v[rolling_px:period_px - jitter_px,
+                      n2c[channel + '_TTL']] = 3
+                v[rolling_px:period_px - jitter_px,
+                  n2c[channel + '_power']] = 4.5 * power / 100
+                voltages.append(v)
+    return np.concatenate(voltages, axis=0), period_px
+
+def native_reference(data, scan_step_size_px):
+    # Reference: the original one slice at a time 'DataNative.get'
+    vo, slices, ch, h_px, w_px = data.shape
+    shear_max = int(np.rint(scan_step_size_px * (slices - 1)))
+    native = np.zeros((vo, slices, ch, h_px + shear_max, w_px), 'uint16')
+    for v in range(vo):
+        for c in range(ch):
+            for i in range(slices):
+                shear = int(np.rint(i * scan_step_size_px))
+                native[v, i, c, shear:h_px + shear, :] = data[v, i, c]
+    return native
+
+def preview_reference(data, s_px, l_px, c_px, timestamp_mode):
+    # Reference: the original one slice at a time 'DataPreview.get' (with
+    # nearest pixel 'zoom', as documented for the preview)
+    vo, slices, ch, h_px, w_px = data.shape
+    shape = sols.DataPreview.shape(
+        vo, slices, ch, h_px, w_px, s_px, l_px, c_px, timestamp_mode)
+    m = np.zeros(shape, 'uint16')
+    t_px, b_px = 2 * (c_px,)
+    if timestamp_mode == "binary+ASCII": t_px = 8
+    prop_px = h_px - t_px - b_px
+    data = data[:, :, :, t_px:h_px - b_px, :]
+    prop_px_per_scan_step = sols.calculate_scan_step_size_um(s_px) / (
+        sols.sample_px_um * np.cos(sols.tilt))
+    prop_shear_max = int(np.rint(prop_px_per_scan_step * (slices - 1)))
+    scan_steps_per_prop_px = 1 / prop_px_per_scan_step
+    scan_shear_max = int(np.rint(scan_steps_per_prop_px * (prop_px - 1)))
+    for v in range(vo):
+        for c in range(ch):
+            O1_proj = np.zeros((prop_px + prop_shear_max, w_px), 'uint16')
+            width_proj = np.zeros((slices + scan_shear_max, prop_px), 'uint16')
+            max_width = np.amax(data[v, :, c, :, :], axis=2)
+            scan_proj = np.amax(data[v, :, c, :, :], axis=0)
+            for i in range(slices):
+                shear = int(np.rint(i * prop_px_per_scan_step))
+                target = O1_proj[shear:prop_px + shear, :]
+                np.maximum(target, data[v, i, c, :, :], out=target)
+            for i in range(prop_px):
+                shear = int(np.rint(i * scan_steps_per_prop_px))
+                width_proj[shear:slices + shear, i] = max_width[:, i]
+            cos, sin = np.cos(sols.tilt), np.sin(sols.tilt)
+            O1_img = zoom(O1_proj, (cos, 1), order=0, mode='nearest')
+            scan_img = zoom(scan_proj, (sin, 1), order=0, mode='nearest')
+            scan_scale = O1_img.shape[0] / width_proj.shape[0]
+            width_img = zoom(
+                width_proj, (scan_scale, sin), order=0, mode='nearest')
+            y_px, x_px = O1_img.shape
+            line_min, line_max = O1_img.min(), O1_img.max()
+            m[v, c, l_px:y_px + l_px, l_px:x_px + l_px] = O1_img
+            m[v, c, y_px + 2*l_px:, l_px:x_px + l_px] = np.flipud(scan_img)
+            m[v, c, l_px:y_px + l_px, x_px + 2*l_px:] = np.fliplr(width_img)
+            m[v, c, :l_px,    :] = line_max
+            m[v, c, :l_px, ::10] = line_min
+            m[v, c, y_px + l_px:y_px + 2*l_px,    :] = line_max
+            m[v, c, y_px + l_px:y_px + 2*l_px, ::10] = line_min
+            m[v, c, :,    :l_px] = line_max
+            m[v, c, ::10, :l_px] = line_min
+            m[v, c, :,    x_px + l_px:x_px + 2*l_px] = line_max
+            m[v, c, ::10, x_px + l_px:x_px + 2*l_px] = line_min
+            m[v, c, :] = np.flipud(m[v, c, :])
+    return m
+
+def test_preview_matches_reference():
+    for shape, s_px, ts in (((1, 20, 1, 60, 100), 1, 'binary+ASCII'),
+                            ((2, 17, 3, 44, 70), 2, 'off'),
+                            ((3, 5, 1, 20, 60), 3, 'binary')):
+        data = make_data(*shape)
+        preview = sols.DataPreview().get(data, s_px, 10, 3, ts)
+        assert np.array_equal(
+            preview, preview_reference(data, s_px, 10, 3, ts))
+
+def test_native_matches_reference():
+    for shape, s_px in (((1, 20, 1, 30, 40), 1),
+                        ((2, 7, 3, 12, 9), 3),
+                        ((2, 9, 2, 10, 6), 1.5)):
+        data = make_data(*shape)
+        native = sols.DataNative().get(data, s_px)
+        assert np.array_equal(native, native_reference(data, s_px))
+
+def test_traditional_crop_and_tiles():
+    data = make_data(1, 20, 1, 30, 16)
+    datatraditional = sols.DataTraditional()
+    for order in (0, 1):
+        full = datatraditional.get_from_raw(data, 3, order=order)
+        crop, shape = datatraditional.crop_shape(
+            data.shape, 3, True, order, 'occupied')
+        (z0, z1), (y0, y1), (x0, x1) = crop
+        # 'occupied' loses no (non zero) voxels:
+        cropped = full[:, z0:z1, :, y0:y1, x0:x1]
+        assert full.sum(dtype='int64') == cropped.sum(dtype='int64')
+        untiled = datatraditional.get_from_raw(
+            data, 3, order=order, crop='occupied')
+        tiled = datatraditional.get_from_raw(
+            data, 3, order=order, crop='occupied', tile_px=(7, 5))
+        assert untiled.shape == tiled.shape == shape
+        assert np.array_equal(untiled, tiled)
+
+def test_waveform_matches_dense_voltages():
+    for settings in ({}, {'channels_per_slice':('LED',),
+                          'power_per_channel':(50,),
+                          'volumes_per_buffer':2,
+                          'camera_preframes':0}):
+        scope = make_microscope(**settings)
+        voltages = scope._calculate_voltages()
+        reference = dense_voltages(scope)[0]
+        assert np.array_equal(voltages.to_array(), reference)
+        assert np.array_equal(
+            np.concatenate(list(voltages.chunks(max_px=1000))), reference)
+        assert np.array_equal(
+            sols._Waveform.from_array(reference).to_array(), reference)
+
+def test_lasers_off_between_volumes():
+    _, period_px = dense_voltages(make_microscope())
+    n2c = make_microscope().names_to_voltage_channels
+    lasers = [n2c[k] for k in ('488_TTL', '488_power', '561_TTL', '561_power')]
+    reference = make_microscope()._calculate_voltages().to_array()
+    for settings in ({'bidirectional_scan':True},
+                     {'galvo_flyback_us':500},
+                     {'galvo_flyback_us':500, 'inter_volume_delay_s':0.01},
+                     {'bidirectional_scan':True, 'inter_volume_delay_s':0.01}):
+        voltages = make_microscope(**settings)._calculate_voltages().to_array()
+        # Same triggers and light, with the light only in a camera period:
+        triggers = np.flatnonzero(np.diff(
+            voltages[:, n2c['camera']] > 0, prepend=0) > 0)
+        assert len(triggers) == len(np.flatnonzero(np.diff(
+            reference[:, n2c['camera']] > 0, prepend=0) > 0))
+        light_on = np.flatnonzero(np.any(voltages[:, lasers] > 0, axis=1))
+        assert len(light_on) == np.any(reference[:, lasers] > 0, axis=1).sum()
+        last_trigger = triggers[np.searchsorted(triggers, light_on) - 1]
+        assert np.all(light_on - last_trigger < period_px)
+
+def test_roi_from_preview_min_height():
+    # 'height_px=12' (min) with 'binary+ASCII' leaves no scan image rows in
+    # the preview, so the roi should fall back to the full range:
+    s_px, slices = sols.calculate_cuboid_voxel_scan(2, 50)
+    data = make_data(1, slices, 1, 12, 512)
+    l_px, c_px, ts = 10, 3, 'binary+ASCII'
+    preview = sols.DataPreview().get(data, s_px, l_px, c_px, ts)
+    roi = sols.DataRoi().get_indices_from_preview(
+        preview, slices, 12, 512, s_px, l_px, c_px, ts)
+    for (i0, i1), max_px in zip(roi, (slices, 12, 512)):
+        assert 0 <= i0 < i1 <= max_px
+    assert roi[1] == sols.DataRoi().get_indices(data, c_px, ts)[1]
+
+def test_focus_map_collinear_anchors():
+    # A single row of tiles (or a line of wells) has collinear anchors,
+    # which can't support a thin plate spline:
+    xy_mm = [(x, 0.0) for x in np.linspace(0, 5, 10)]
+    focus_map = sols.FocusMap(xy_mm)
+    anchors = focus_map.choose_anchors(10)
+    for i in anchors:
+        focus_map.update(i, 10 + 2 * xy_mm[i][0])
+    z_um = focus_map.get()
+    assert np.allclose(z_um, [10 + 2 * x for x, y in xy_mm])